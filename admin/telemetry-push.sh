@@ -0,0 +1,21 @@
+#!/bin/sh
+# Push the telemetry of the node to the agent API (installed during the deployment of the node)
+# The @...@ values are replaced by raspberry.exec.install_telemetry()
+URL="http://@PIMASTER_IP@:@API_PORT@/v1/telemetry/push"
+NODE="@NODE_NAME@"
+# Send the samples of the last 10 seconds in one request
+BATCH=10
+while true; do
+    SAMPLES=""
+    i=0
+    while [ $i -lt $BATCH ]; do
+        TEMP=$(cat /sys/class/thermal/thermal_zone0/temp)
+        LOAD=$(cut -d ' ' -f 1 /proc/loadavg)
+        MEM=$(awk '/MemTotal/ { t = $2 } /MemAvailable/ { a = $2 } END { printf "%.1f", (t - a) * 100 / t }' /proc/meminfo)
+        SAMPLES="$SAMPLES{\"time\": $(date +%s), \"temperature\": $((TEMP / 1000)), \"load\": $LOAD, \"memory\": $MEM},"
+        i=$((i + 1))
+        sleep 1
+    done
+    curl -s -m 5 -H "Content-Type: application/json" \
+        -d "{\"node\": \"$NODE\", \"samples\": [${SAMPLES%,}]}" "$URL" > /dev/null
+done
@@ -10,7 +10,9 @@ load_config(sys.argv[1])
 
 from api.admin_v1 import admin_v1
 from api.debug_v1 import debug_v1
+from api.telemetry_v1 import telemetry_v1
 from api.user_v1 import user_v1
+from database.connector import migrate_properties, upgrade_tables
 from flask import Flask
 from importlib import import_module
 import logging, os, sys
@@ -21,6 +23,44 @@ agent_api = Flask(__name__)
 agent_api.register_blueprint(user_v1, url_prefix='/v1/user/')
 agent_api.register_blueprint(admin_v1, url_prefix='/v1/admin/')
 agent_api.register_blueprint(debug_v1, url_prefix='/v1/debug/')
+# The deployed nodes push their telemetry values (optional)
+if get_config().get("telemetry_push", False):
+    agent_api.register_blueprint(telemetry_v1, url_prefix='/v1/telemetry/')
+
+
+# Serve the application with several worker processes (see 'api_server' in config_agent.json)
+# Send SIGHUP to the main process to gracefully restart the workers
+def run_gunicorn(port_number):
+    from database.base import engine
+    from gunicorn.app.base import BaseApplication
+
+    class AgentApplication(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_conf.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return agent_api
+
+    def post_fork(server, worker):
+        # Do not share the DB connections of the main process with the workers
+        engine.dispose()
+
+    gunicorn_conf = {
+        "bind": "0.0.0.0:%d" % port_number,
+        "worker_class": "gthread",
+        # Number of processes and number of threads per process
+        "workers": get_config().get("api_workers", 4),
+        "threads": get_config().get("api_threads", 8),
+        # Restart the workers that do not answer after this number of seconds
+        "timeout": get_config().get("api_timeout", 120),
+        "graceful_timeout": get_config().get("api_graceful_timeout", 15),
+        "keepalive": get_config().get("api_keepalive", 5),
+        "errorlog": "info_api.log",
+        "post_fork": post_fork
+    }
+    AgentApplication().run()
+
 
 if __name__ == '__main__':
     logging.basicConfig(filename='info_api.log', level=logging.INFO,
@@ -40,6 +80,13 @@ if __name__ == '__main__':
     # Get the python module from the type of the nodes managed by this agent
     node_type = get_config()["node_type"]
     api_exec_mod = import_module("%s.api" % node_type)
+    # Add the new columns to the tables of existing databases (the API can start before the executor)
+    upgrade_tables()
+    migrate_properties()
     # Start the application
     port_number = get_config()["port_number"]
-    agent_api.run(port=port_number, host="0.0.0.0")
+    if get_config().get("api_server", "flask") == "gunicorn":
+        run_gunicorn(port_number)
+    else:
+        # Development server: one process, one thread per request
+        agent_api.run(port=port_number, host="0.0.0.0", threaded=True)
@@ -7,12 +7,14 @@ if len(sys.argv) != 2:
     sys.exit(2)
 load_config(sys.argv[1])
 
-from database.connector import open_session, close_session
-from database.tables import Action, ActionProperty, RaspNode, Schedule
+from concurrent.futures import ThreadPoolExecutor, wait
+from database.connector import open_session, close_session, get_node_conf, migrate_properties, upgrade_tables
+from database.tables import Action, ActionProperty, NodeConf, RaspEnvironment, RaspNode, Schedule
 from datetime import datetime
 from importlib import import_module
 from lib.config_loader import load_config
-from sqlalchemy import or_
+from lib.notify import open_notify_socket, wait_notification
+from sqlalchemy import func, or_
 import logging, os, subprocess, sys, time
 
 
@@ -24,6 +26,14 @@ exec_action_mod = import_module("%s.exec" % node_type)
 py_module = import_module("%s.states" % node_type)
 PROCESS = getattr(py_module, "PROCESS")
 STATE_DESC = getattr(py_module, "STATE_DESC")
+# The maximum number of nodes processed at the same time (1: the actions are executed one by one)
+EXEC_WORKERS = get_config().get("exec_workers", 1)
+# Delay in seconds before executing the next state function of an action
+STEP_DELAY = 1
+# Default delay in seconds before executing again a state function that fails
+POLL_INTERVAL = 3
+# Maximum sleeping time in seconds when the API can wake up the executor
+MAX_SLEEP = 10
 
 
 # Move the action to the next state of the process
@@ -52,6 +62,7 @@ def next_state_move(db_action):
     # Set the state of the action to the next state of the process
     db_action.state = state_list[db_action.state_idx]
     db_action.updated_at = int(time.time())
+    db_action.failures = 0
     logging.info("[%s] changes to the '%s' state" % (db_action.node_name, db_action.state))
     return True
 
@@ -68,25 +79,21 @@ def new_action(db_node, db):
         node_ip = None
     # Add a new action
     act = Action()
-    act_prop = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == db_node.node_name
-        ).filter(ActionProperty.prop_name == "environment"
-        ).first()
-    if act_prop is not None:
-        act.environment = act_prop.prop_value
+    node_conf = db.query(NodeConf).filter(NodeConf.node_name == db_node.node_name).first()
+    if node_conf is not None:
+        act.environment = node_conf.environment
     act.node_name = db_node.node_name
     if node_ip is not None:
         act.node_ip = node_ip
+    # The new row replaces the deleted row with an UPDATE (same primary key): reset the polling values
+    act.next_run = None
+    act.failures = 0
     db_node.state = "in_progress"
     return act
 
 
 def save_reboot_state(db_action, db):
     reboot_str = ""
-    reboot_state = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == db_action.node_name
-        ).filter(ActionProperty.prop_name == "reboot_state"
-        ).first()
     if db_action.state_idx is None:
         # This is an hardreboot action initiated by the user, check if the node is deployed
         is_deployed = db.query(Schedule
@@ -101,18 +108,7 @@ def save_reboot_state(db_action, db):
         reboot_str = "%s?!%d" % (db_action.process, db_action.state_idx)
     if len(reboot_str) > 0:
         # Remember the last state of the current process
-        if reboot_state is None:
-            owner_email = db.query(ActionProperty
-                ).filter(ActionProperty.node_name == db_action.node_name
-                ).first().owner
-            reboot_prop = ActionProperty()
-            reboot_prop.node_name = db_action.node_name
-            reboot_prop.prop_name = "reboot_state"
-            reboot_prop.prop_value = reboot_str
-            reboot_prop.owner = owner_email
-            db.add(reboot_prop)
-        else:
-            reboot_state.prop_value = reboot_str
+        get_node_conf(db, db_action.node_name).reboot_state = reboot_str
 
 
 def init_action_process(db_action, process_name):
@@ -123,13 +119,13 @@ def init_action_process(db_action, process_name):
 
 
 def load_reboot_state(db_action, db):
-    reboot_state = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == db_action.node_name
-        ).filter(ActionProperty.prop_name == "reboot_state"
-        ).first()
-    if reboot_state is not None and reboot_state.prop_value is not None and len(reboot_state.prop_value) > 0:
-        logging.info("[%s] load the reboot state '%s'" % (db_action.node_name, reboot_state.prop_value))
-        process_info = reboot_state.prop_value.split("?!")
+    node_conf = db.query(NodeConf).filter(NodeConf.node_name == db_action.node_name).first()
+    reboot_state = None
+    if node_conf is not None:
+        reboot_state = node_conf.reboot_state
+    if reboot_state is not None and len(reboot_state) > 0:
+        logging.info("[%s] load the reboot state '%s'" % (db_action.node_name, reboot_state))
+        process_info = reboot_state.split("?!")
         if len(process_info) == 2:
             db_action.process = process_info[0]
             idx = int(process_info[1])
@@ -141,7 +137,7 @@ def load_reboot_state(db_action, db):
             return True
         else:
             logging.error("[%s] can not find the process for the '%s' state" % (
-                db_action.node_name, reboot_state.prop_value))
+                db_action.node_name, reboot_state))
     else:
         logging.error("[%s] can not detect the reboot_state" % db_action.node_name)
     return False
@@ -152,12 +148,138 @@ def free_reserved_node(db, node_name):
     properties = db.query(ActionProperty).filter(ActionProperty.node_name == node_name).all()
     for prop in properties:
         db.delete(prop)
+    node_conf = db.query(NodeConf).filter(NodeConf.node_name == node_name).first()
+    if node_conf is not None:
+        db.delete(node_conf)
     # Delete reservations to the schedule
     reservations = db.query(Schedule).filter(Schedule.node_name == node_name).all()
     for res in reservations:
         db.delete(res)
 
 
+# Return the lost timeout of the state (the 'lost_delay' setting is added to the 'lost' value)
+def lost_timeout(state):
+    desc = STATE_DESC[state]
+    if desc["lost"] > 0 and "lost_delay" in desc:
+        return desc["lost"] + get_config().get(desc["lost_delay"], 0)
+    return desc["lost"]
+
+
+# Compute the date of the next execution of a state function that fails
+def next_poll_date(action, state, now):
+    desc = STATE_DESC[state]
+    failures = action.failures or 0
+    # Exponential backoff from the 'poll' interval of the state
+    delay = desc.get("poll", POLL_INTERVAL) * desc.get("backoff", 1) ** failures
+    if "max_poll" in desc:
+        delay = min(delay, desc["max_poll"])
+    next_date = now + delay
+    # Do not miss the reboot timeout and the lost timeout of the state
+    for timeout in [ desc["before_reboot"], lost_timeout(state) ]:
+        deadline = action.updated_at + timeout + 1
+        if timeout > 0 and now < deadline < next_date:
+            next_date = deadline
+    return int(next_date)
+
+
+# Load the rows read by the state functions in a few queries (instead of one query per state function)
+#   nodes: the RaspNode rows of the actions and the pimaster, indexed by name
+#   envs: the RaspEnvironment rows of the actions, indexed by name
+#   confs: the NodeConf rows of the actions indexed by node_name
+def load_context(db, actions):
+    node_names = [ action.node_name for action in actions ]
+    env_names = set([ action.environment for action in actions if action.environment is not None ])
+    ctx = { "nodes": {}, "envs": {}, "confs": {} }
+    if len(node_names) == 0:
+        return ctx
+    for node in db.query(RaspNode).filter(RaspNode.name.in_(node_names + [ "pimaster" ])).all():
+        ctx["nodes"][node.name] = node
+    if len(env_names) > 0:
+        for env in db.query(RaspEnvironment).filter(RaspEnvironment.name.in_(env_names)).all():
+            ctx["envs"][env.name] = env
+    for node_conf in db.query(NodeConf).filter(NodeConf.node_name.in_(node_names)).all():
+        ctx["confs"][node_conf.node_name] = node_conf
+    # The nodes and the environments are not modified by the state functions, they are shared by the workers
+    for row in list(ctx["nodes"].values()) + list(ctx["envs"].values()):
+        db.expunge(row)
+    return ctx
+
+
+def execute_action(action, db, ctx, now):
+    state = action.state.replace("_exec", "").replace("_post","")
+    state_fct = action.state
+    if not state_fct.endswith("_exec") and not state_fct.endswith("_post"):
+        if STATE_DESC[action.state]["exec"]:
+            state_fct = action.state + "_exec"
+        else:
+            state_fct = action.state + "_post"
+    # Execute the function associated to the action state
+    action_ret = False
+    try:
+        action_ret = getattr(exec_action_mod, state_fct)(action, db, ctx)
+    except:
+        logging.exception("[%s]" % action.node_name)
+        sys.exit(42)
+    if action_ret:
+        logging.info("[%s] successfully executes '%s'" % (action.node_name, state_fct))
+        action.next_run = int(time.time()) + STEP_DELAY
+        # Update the state of the action
+        if state_fct.endswith("_exec") and STATE_DESC[state]["post"]:
+            # Execute the '_post' function
+            action.state = state_fct.replace("_exec", "_post")
+            action.failures = 0
+        else:
+            # Move to the next state of the process
+            next_state_move(action)
+    else:
+        # The node is not ready, test the reboot timeout
+        logging.warning("[%s] fails to execute '%s'" % (action.node_name, state_fct))
+        if action.updated_at is None:
+            action.updated_at = int(time.time())
+        action.next_run = next_poll_date(action, state, int(time.time()))
+        action.failures = (action.failures or 0) + 1
+        elapsedTime = now - action.updated_at
+        reboot_timeout = STATE_DESC[state]["before_reboot"]
+        do_lost = True
+        reboot_str = "%s?!%d" % (action.process, action.state_idx)
+        reboot_state = None
+        if action.node_name in ctx["confs"]:
+            reboot_state = ctx["confs"][action.node_name].reboot_state
+        if reboot_timeout > 0 and action.process != "reboot" and reboot_state != reboot_str:
+            do_lost = False
+            if elapsedTime > reboot_timeout:
+                logging.warning("[%s] hard reboot the node" % action.node_name)
+                save_reboot_state(action, db)
+                init_action_process(action, "reboot")
+                action.next_run = int(time.time()) + STEP_DELAY
+            else:
+                logging.info("[%s] not ready since %d seconds" % (action.node_name, elapsedTime))
+        # The node is not ready, test the lost timeout
+        lost_after = lost_timeout(state)
+        if do_lost and lost_after > 0:
+            if elapsedTime > lost_after:
+                logging.warning("[%s] is lost. Stop monitoring it!" % action.node_name)
+                if action.process != "reboot":
+                    save_reboot_state(action, db)
+                action.state = "lost"
+            else:
+                logging.info("[%s] not ready since %d seconds" %(action.node_name, elapsedTime))
+
+
+# Execute the action of the node from a worker of the pool (every worker uses its own DB session)
+# The action and its configuration are detached from the session of the main loop
+def execute_node_action(action, ctx, now):
+    db = open_session()
+    try:
+        # Attach the rows to the session of the worker without querying the database
+        action = db.merge(action, load = False)
+        if action.node_name in ctx["confs"]:
+            ctx["confs"][action.node_name] = db.merge(ctx["confs"][action.node_name], load = False)
+        execute_action(action, db, ctx, now)
+    finally:
+        close_session(db)
+
+
 if __name__ == "__main__":
     # This file used by the SystemD service
     STOP_FILE = "execstop"
@@ -171,6 +293,15 @@ if __name__ == "__main__":
         if not STATE_DESC[state]["exec"] and not STATE_DESC[state]["post"]:
             final_states.append(state)
     logging.info("### Final states: %s" % final_states)
+    # Add the new columns to the tables of existing databases
+    upgrade_tables()
+    migrate_properties()
+    # Receive the notifications from the API
+    notify_sock = open_notify_socket()
+    if notify_sock is None:
+        max_sleep = POLL_INTERVAL
+    else:
+        max_sleep = MAX_SLEEP
     # Connection to the database
     db = open_session()
     # Register the information about the pimaster (me)
@@ -231,23 +362,29 @@ if __name__ == "__main__":
             # The action is successfully configured, add it
             db.add(act)
             # Delete the reboot_state to allow the node to reboot
-            reboot_state = db.query(ActionProperty
-                ).filter(ActionProperty.node_name == node.node_name
-                ).filter(ActionProperty.prop_name == "reboot_state"
-                ).first()
-            if reboot_state is not None:
-                reboot_state.prop_value = None
+            node_conf = db.query(NodeConf).filter(NodeConf.node_name == node.node_name).first()
+            if node_conf is not None:
+                node_conf.reboot_state = None
         else:
             # The reboot action can not be executed
             node.state = "ready"
     close_session(db)
+    # Execute the state functions of different nodes in parallel
+    if EXEC_WORKERS > 1:
+        logging.info("### Execute the actions with %d workers" % EXEC_WORKERS)
+        worker_pool = ThreadPoolExecutor(max_workers = EXEC_WORKERS)
     # Analyzing the database
     while not os.path.isfile(STOP_FILE):
+        sleep_time = POLL_INTERVAL
         db = open_session()
         try:
             # Release the expired nodes
             now = int(time.time())
-            for node in db.query(Schedule).filter(Schedule.end_date < now).all():
+            expired_nodes = db.query(Schedule).filter(Schedule.end_date < now).all()
+            if len(expired_nodes) > 0:
+                destroy_nodes = [ row.node_name for row in db.query(Action.node_name
+                    ).filter(Action.process == "destroy").all() ]
+            for node in expired_nodes:
                 logging.info("[%s] Destroy the expired reservation (expired date: %s)" % (
                     node.node_name, datetime.fromtimestamp(node.end_date)))
                 # The reservation is expired, delete it
@@ -256,10 +393,7 @@ if __name__ == "__main__":
                     free_reserved_node(db, node.node_name)
                 else:
                     # Check if a destroy action is in progress
-                    destroy_action = db.query(Action
-                        ).filter(Action.node_name == node.node_name
-                        ).filter(Action.process == "destroy").all()
-                    if len(destroy_action) == 0:
+                    if node.node_name not in destroy_nodes:
                         node_action = new_action(node, db)
                         init_action_process(node_action, "destroy")
                         db.add(node_action)
@@ -272,14 +406,18 @@ if __name__ == "__main__":
             db.commit()
             # Delete the actions in final states
             final_actions = db.query(Action).filter(Action.state.in_(final_states)).all()
+            in_progress = {}
+            if len(final_actions) > 0:
+                for node in db.query(Schedule
+                    ).filter(Schedule.state == "in_progress"
+                    ).filter(Schedule.node_name.in_([ action.node_name for action in final_actions ])
+                    ).all():
+                    in_progress.setdefault(node.node_name, node)
             for action in final_actions:
                 logging.info("[%s] action is completed (current state: '%s')" % (
                     action.node_name, action.state))
                 # Update the action_state of the reservation
-                node = db.query(Schedule
-                    ).filter(Schedule.state == "in_progress"
-                    ).filter(Schedule.node_name == action.node_name
-                    ).first()
+                node = in_progress.get(action.node_name)
                 if node is not None:
                     node.state = "ready"
                     node.action_state = action.state
@@ -302,8 +440,11 @@ if __name__ == "__main__":
                     act = new_action(node, db)
                     init_action_process(act, "deploy")
                     db.add(act)
-            # Process the ongoing actions
+            # Save the new actions before loading the working set of the state functions
+            db.commit()
+            # Process the ongoing actions that are due
             pending_actions = db.query(Action).filter(~Action.state.in_(final_states)
+                ).filter(or_(Action.next_run == None, Action.next_run <= now)
                 ).all()
             # Sort the actions according the list of states
             sorted_actions = { key: [] for key in STATE_DESC.keys() }
@@ -313,69 +454,59 @@ if __name__ == "__main__":
                     sorted_actions[action_state].append(action)
                 else:
                     logging.warning("[%s] unknow state '%s'" % (action.node_name, action.state))
+                    action.next_run = now + POLL_INTERVAL
+            # Load the rows used by the state functions
+            ctx = load_context(db, [ action for state in sorted_actions for action in sorted_actions[state] ])
             # Execute the functions of the states
-            for state in sorted_actions:
-                for action in sorted_actions[state]:
-                    state_fct = action.state
-                    if not state_fct.endswith("_exec") and not state_fct.endswith("_post"):
-                        if STATE_DESC[action.state]["exec"]:
-                            state_fct = action.state + "_exec"
-                        else:
-                            state_fct = action.state + "_post"
-                    # Execute the function associated to the action state
-                    action_ret = False
-                    try:
-                        action_ret = getattr(exec_action_mod, state_fct)(action, db)
-                    except:
-                        logging.exception("[%s]" % action.node_name)
-                        sys.exit(42)
-                    if action_ret:
-                        logging.info("[%s] successfully executes '%s'" % (action.node_name, state_fct))
-                        # Update the state of the action
-                        if state_fct.endswith("_exec") and STATE_DESC[state]["post"]:
-                            # Execute the '_post' function
-                            action.state = state_fct.replace("_exec", "_post")
-                        else:
-                            # Move to the next state of the process
-                            next_state_move(action)
-                    else:
-                        # The node is not ready, test the reboot timeout
-                        logging.warning("[%s] fails to execute '%s'" % (action.node_name, state_fct))
-                        if action.updated_at is None:
-                            action.updated_at = int(time.time())
-                        elapsedTime = now - action.updated_at
-                        action_state = action.state.replace("_exec", "").replace("_post","")
-                        reboot_timeout = STATE_DESC[action_state]["before_reboot"]
-                        do_lost = True
-                        reboot_str = "%s?!%d" % (action.process, action.state_idx)
-                        reboot_state = db.query(ActionProperty
-                                ).filter(ActionProperty.node_name == action.node_name
-                                ).filter(ActionProperty.prop_name == "reboot_state"
-                                ).first()
-                        if reboot_timeout > 0 and action.process != "reboot" \
-                            and (reboot_state is None or reboot_state.prop_value != reboot_str):
-                            do_lost = False
-                            if elapsedTime > reboot_timeout:
-                                logging.warning("[%s] hard reboot the node" % action.node_name)
-                                save_reboot_state(action, db)
-                                init_action_process(action, "reboot")
-                            else:
-                                logging.info("[%s] not ready since %d seconds" % (action.node_name, elapsedTime))
-                        # The node is not ready, test the lost timeout
-                        lost_timeout = STATE_DESC[action_state]["lost"]
-                        if do_lost and lost_timeout > 0:
-                            if elapsedTime > lost_timeout:
-                                logging.warning("[%s] is lost. Stop monitoring it!" % action.node_name)
-                                if action.process != "reboot":
-                                    save_reboot_state(action, db)
-                                action.state = "lost"
-                            else:
-                                logging.info("[%s] not ready since %d seconds" %(action.node_name, elapsedTime))
+            if EXEC_WORKERS > 1:
+                futures = []
+                for state in sorted_actions:
+                    for action in sorted_actions[state]:
+                        # The worker attaches the action and its configuration to its own DB session
+                        db.expunge(action)
+                        if action.node_name in ctx["confs"]:
+                            db.expunge(ctx["confs"][action.node_name])
+                        # One task per node: the actions of a node are never executed concurrently
+                        futures.append(worker_pool.submit(execute_node_action, action, ctx, now))
+                # Wait for the end of all the tasks before raising the exceptions of the workers
+                # (a node must not be submitted again while its worker is running)
+                wait(futures)
+                for f in futures:
+                    f.result()
+            else:
+                for state in sorted_actions:
+                    for action in sorted_actions[state]:
+                        execute_action(action, db, ctx, now)
+            db.commit()
+            # Sleep until the next due action, the next reservation start or the next reservation end
+            next_dates = [ now + max_sleep ]
+            if db.query(Action.node_name).filter(~Action.state.in_(final_states)
+                ).filter(Action.next_run == None).first() is not None:
+                next_dates.append(now)
+            next_run = db.query(func.min(Action.next_run)).filter(~Action.state.in_(final_states)).scalar()
+            if next_run is not None:
+                next_dates.append(next_run)
+            next_start = db.query(func.min(Schedule.start_date)
+                ).filter(Schedule.state == "ready"
+                ).filter(Schedule.action_state == ""
+                ).filter(Schedule.start_date >= now
+                ).scalar()
+            if next_start is not None:
+                next_dates.append(next_start + 1)
+            next_end = db.query(func.min(Schedule.end_date)).filter(Schedule.end_date >= now).scalar()
+            if next_end is not None:
+                next_dates.append(next_end + 1)
+            sleep_time = max(min(next_dates) - time.time(), 0)
         except Exception as e:
             logging.exception("Node process error")
         close_session(db)
-        # Waiting for the node configuration
-        time.sleep(3)
+        # Waiting for the next due date or a notification from the API
+        if notify_sock is None:
+            time.sleep(sleep_time)
+        else:
+            wait_notification(notify_sock, sleep_time)
+    if EXEC_WORKERS > 1:
+        worker_pool.shutdown()
     if os.path.isfile(STOP_FILE):
         os.remove(STOP_FILE)
     logging.info("### The piTasks service is stopped.")
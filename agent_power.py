@@ -11,49 +11,85 @@ load_config(sys.argv[1])
 from database.connector import open_session, close_session
 from database.tables import RaspSwitch
 from datetime import datetime
-from influxdb import InfluxDBClient
-from lib.switch_snmp import switch_cons
-import logging, time
+from lib.influx_writer import create_database, write_points
+from lib.switch_snmp import snmp_cons
+from pysnmp.hlapi.asyncio import SnmpEngine
+import asyncio, logging, time
+
+# Interval in seconds between two samples of the switch consumptions
+SAMPLE_PERIOD = 10
+# Maximum time in seconds to read the consumptions of one switch (the sample is missed after this deadline)
+SWITCH_DEADLINE = get_config().get("power_deadline", 8)
+
+
+# Read the consumptions of the switch, return None if the sample is missed
+async def read_switch(engine, switch):
+    try:
+        return await asyncio.wait_for(snmp_cons(engine, switch["ip"], switch["community"], switch["power_oid"]),
+            SWITCH_DEADLINE)
+    except asyncio.TimeoutError:
+        logging.warning("[%s] no consumption values after %d seconds" % (switch["name"], SWITCH_DEADLINE))
+    except Exception:
+        logging.exception("[%s] can not get the switch consumptions" % switch["name"])
+    return None
+
+
+async def read_sample(engine):
+    db = open_session()
+    switches = [ { "name": s.name, "ip": s.ip, "community": s.community, "power_oid": s.power_oid }
+        for s in db.query(RaspSwitch).all() if s.power_oid is not None and len(s.power_oid) > 5 ]
+    close_session(db)
+    record_time = datetime.utcnow().replace(microsecond=0).isoformat()
+    # Read the switches at the same time
+    all_cons = await asyncio.gather(*[ read_switch(engine, s) for s in switches ])
+    influx_points = []
+    for switch, cons in zip(switches, all_cons):
+        if cons is None or len(cons) == 0:
+            # Record the missed sample to distinguish it from a monitoring gap
+            influx_points.append({
+                "measurement": "power_missed",
+                "tags": { "switch": switch["name"] },
+                "time": record_time,
+                "fields": { "missed": 1 }
+            })
+        for port, watt in enumerate(cons or []):
+            influx_points.append({
+                "measurement": "power_W",
+                "tags": {
+                    "switch": switch["name"],
+                    "port": port + 1
+                },
+                "time": record_time,
+                "fields": {
+                    "consumption": watt
+                }
+            })
+    # The points are buffered and sent by the writer thread (stored on disk if the InfluxDB is down)
+    if len(influx_points) > 0:
+        write_points(influx_points, "power")
+
+
+async def monitor_switches():
+    engine = SnmpEngine()
+    next_sample = time.time()
+    while True:
+        try:
+            await read_sample(engine)
+        except Exception:
+            # The next samples are recorded (for example, after a 'database is locked' error)
+            logging.exception("Can not record the switch consumptions")
+        # Keep a fixed sampling period whatever the duration of the SNMP requests
+        next_sample += SAMPLE_PERIOD
+        now = time.time()
+        if next_sample < now:
+            next_sample = now
+        await asyncio.sleep(next_sample - now)
 
 
 logging.basicConfig(filename='info_monitoring.log', level=logging.INFO,
     format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-db = open_session()
-influx = InfluxDBClient(host='localhost', port=8086)
-influx_dbs = [info["name"] for info in influx.get_list_database()]
-if "monitoring" not in influx_dbs:
-    logging.warning("No 'monitoring' database. Create the 'monitoring' database")
-    influx.create_database('monitoring')
-influx.switch_database('monitoring')
+# Create the database receiving the points of the writer
+create_database()
 logging.info("The monitoring agent is running!")
-while True:
-    start_time = datetime.utcnow()
-    record_time = datetime.utcnow()
-    try:
-        for s in db.query(RaspSwitch).all():
-            if len(s.power_oid) > 5:
-                cons = switch_cons(s.ip, s.community, s.power_oid)
-                influx_points = []
-                record_time = datetime.utcnow().replace(microsecond=0).isoformat()
-                for port, watt in enumerate(cons):
-                    influx_points.append({
-                        "measurement": "power_W",
-                        "tags": {
-                            "switch": s.name,
-                            "port": port + 1
-                        },
-                        "time": record_time,
-                        "fields": {
-                            "consumption": watt
-                        }
-                    })
-                influx.write_points(influx_points)
-                # Update the record_time to compute the elapsed time between to sleep.time()
-                record_time = datetime.utcnow()
-    except:
-        logging.exception("Can not get the switch consumptions")
-    diff_time = (record_time - start_time).total_seconds()
-    if diff_time < 10:
-        time.sleep(10 - diff_time)
-close_session(db)
+asyncio.run(monitor_switches())
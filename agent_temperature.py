@@ -8,61 +8,89 @@ if len(sys.argv) != 2:
     sys.exit(2)
 load_config(sys.argv[1])
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from database.connector import open_session, close_session
-from database.tables import ActionProperty, RaspEnvironment, RaspNode, RaspSwitch, Schedule
+from database.tables import NodeConf, RaspEnvironment, RaspNode, Schedule
 from datetime import datetime
-from influxdb import InfluxDBClient
-from lib.switch_snmp import switch_cons
-import logging, subprocess, time
+from lib.influx_writer import create_database, write_points
+from lib.ssh_pool import ssh_connect, ssh_invalidate
+from lib.telemetry_push import pushing_nodes
+import logging, time
+
+# Interval in seconds between two samples of the node temperatures
+SAMPLE_PERIOD = 10
+# SSH connection timeout in seconds
+SSH_TIMEOUT = 2
+# Maximum time in seconds to read the temperature of one node (the sample is missed after this deadline)
+NODE_DEADLINE = get_config().get("temperature_deadline", 5)
+# The maximum number of nodes read at the same time
+TEMPERATURE_WORKERS = get_config().get("temperature_workers", 16)
+
+
+# Read the temperature of the node from a reused SSH connection
+def read_temperature(node_name, node_ip, ssh_user):
+    try:
+        ssh = ssh_connect(node_ip, ssh_user, SSH_TIMEOUT)
+        (stdin, stdout, stderr) = ssh.exec_command("cat /sys/class/thermal/thermal_zone0/temp",
+            timeout = NODE_DEADLINE)
+        temp_str = stdout.read().decode("utf-8").split()
+        if len(temp_str) > 0 and len(temp_str[0]) > 4:
+            return int(int(temp_str[0]) / 1000)
+    except:
+        logging.exception("[%s] temperature failure" % node_name)
+        ssh_invalidate(node_ip, ssh_user)
+    return None
 
 
 logging.basicConfig(filename='info_temperature.log', level=logging.INFO,
     format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-db = open_session()
-influx = InfluxDBClient(host='localhost', port=8086)
-influx_dbs = [info["name"] for info in influx.get_list_database()]
-if "monitoring" not in influx_dbs:
-    logging.warning("No 'monitoring' database. Create the 'monitoring' database")
-    influx.create_database('monitoring')
-influx.switch_database('monitoring')
+# Create the database receiving the points of the writer
+create_database()
+worker_pool = ThreadPoolExecutor(max_workers = TEMPERATURE_WORKERS)
 logging.info("The temperature agent is running!")
+# The nodes that did not answer before the deadline of the previous samples { node_name: future }
+late_nodes = {}
+next_sample = time.time()
 while True:
-    start_time = datetime.utcnow()
     record_time = datetime.utcnow().replace(microsecond=0)
-    influx_points = []
-    for node_info in db.query(Schedule, RaspNode, ActionProperty, RaspEnvironment
+    db = open_session()
+    nodes = [ (node_info[0].node_name, node_info[1].ip, node_info[3].ssh_user)
+        for node_info in db.query(Schedule, RaspNode, NodeConf, RaspEnvironment
             ).filter(Schedule.action_state == "deployed"
             ).filter(Schedule.node_name == RaspNode.name 
-            ).filter(ActionProperty.prop_name == "environment" 
-            ).filter(ActionProperty.node_name == RaspNode.name 
-            ).filter(RaspEnvironment.name == ActionProperty.prop_value 
-            ).all():
-        try:
-            node = node_info[1]
-            env = node_info[3]
-            cmd = [
-                "ssh", "-o StrictHostKeyChecking=no", "-o ConnectTimeout=2",
-                "%s@%s"%(env.ssh_user, node.ip),
-                "cat /sys/class/thermal/thermal_zone0/temp"
-            ]
-            process = subprocess.run(cmd, stdout=subprocess.PIPE,
-                    stderr=subprocess.DEVNULL, universal_newlines=True, timeout=10)
-            temp_str = process.stdout.split()
-            if len(temp_str) > 0 and len(temp_str[0]) > 4:
-                influx_points.append({
-                    "measurement": "temperature_C",
-                    "time": record_time.isoformat(),
-                    "tags": { "node": node_info[0].node_name },
-                    "fields": {
-                        "consumption": int(int(temp_str[0]) / 1000)
-                    }
-                })
-        except:
-            logging.exception("[%s] temperature failure" % node_info[0].node_name)
+            ).filter(NodeConf.node_name == RaspNode.name 
+            ).filter(RaspEnvironment.name == NodeConf.environment 
+            ).all() ]
+    close_session(db)
+    if get_config().get("telemetry_push", False):
+        # The nodes pushing their telemetry are only read with SSH when they stop pushing
+        pushing = pushing_nodes()
+        nodes = [ node for node in nodes if node[0] not in pushing ]
+    # Read the temperatures of the nodes at the same time (do not read again the nodes that are still late)
+    late_nodes = { name: f for name, f in late_nodes.items() if not f.done() }
+    futures = { worker_pool.submit(read_temperature, *node): node[0] for node in nodes if node[0] not in late_nodes }
+    done, not_done = wait(futures, timeout = NODE_DEADLINE + SSH_TIMEOUT)
+    for f in not_done:
+        logging.warning("[%s] no temperature value before the deadline" % futures[f])
+        late_nodes[futures[f]] = f
+    influx_points = []
+    for f in done:
+        if f.result() is not None:
+            influx_points.append({
+                "measurement": "temperature_C",
+                "time": record_time.isoformat(),
+                "tags": { "node": futures[f] },
+                "fields": {
+                    "consumption": f.result()
+                }
+            })
+    # The points are buffered and sent by the writer thread (stored on disk if the InfluxDB is down)
     if len(influx_points) > 0:
-        influx.write_points(influx_points)
-    diff_time = (record_time - start_time).total_seconds()
-    if diff_time < 10:
-        time.sleep(10 - diff_time)
-close_session(db)
+        write_points(influx_points, "temperature")
+    # Keep a fixed sampling period whatever the duration of the SSH connections
+    next_sample += SAMPLE_PERIOD
+    now = time.time()
+    if next_sample < now:
+        next_sample = now
+    time.sleep(next_sample - now)
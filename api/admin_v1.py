@@ -1,11 +1,11 @@
 from api.auth import auth
 from api.tool import safe_string
 from database.connector import open_session, close_session
-from database.tables import Action, ActionProperty, RaspEnvironment, RaspNode, RaspSwitch 
+from database.tables import Action, ActionProperty, NodeConf, RaspEnvironment, RaspNode, RaspSwitch 
 from datetime import datetime
 from glob import glob
 from lib.config_loader import get_config
-from lib.switch_snmp import get_poe_status, switch_test, turn_on_port, turn_off_port
+from lib.switch_snmp import get_poe_status, switch_test, turn_on_port, turn_off_port, turn_on_ports, turn_off_ports
 from paramiko.ssh_exception import BadHostKeyException, AuthenticationException, SSHException
 from sqlalchemy import distinct
 import flask, json, logging, os, paramiko, shutil, socket, subprocess, time
@@ -83,6 +83,10 @@ def rename_nodes():
             # We assume the node name looks like 'base_name-number'
             current = node.node_name.split("-")[0]
             node.node_name = node.node_name.replace(current, rename_data["base_name"])
+        for node in db.query(NodeConf).all():
+            # We assume the node name looks like 'base_name-number'
+            current = node.node_name.split("-")[0]
+            node.node_name = node.node_name.replace(current, rename_data["base_name"])
     close_session(db)
     if len(error) == 0:
         return json.dumps({ "nodes": nodes })
@@ -292,8 +296,7 @@ def switch_nodes(switch_name):
 @auth
 def turn_on(switch_name):
     if "ports" in flask.request.json:
-        for port in flask.request.json["ports"]:
-            turn_on_port(switch_name, port)
+        turn_on_ports(switch_name, flask.request.json["ports"])
     return json.dumps({})
 
 
@@ -307,13 +310,15 @@ def turn_off(switch_name):
     sw = db.query(RaspSwitch).filter(RaspSwitch.name == switch_name).first()
     master_port = sw.master_port
     close_session(db)
+    ports = []
     for port in flask.request.json["ports"]:
         if port == master_port:
             result["errors"].append("can not turn off the pimaster")
             logging.error("can not turn off the pimaster on the port  %s of the switch '%s'" % (
                 port, switch_name))
         else:
-            turn_off_port(switch_name, port)
+            ports.append(port)
+    turn_off_ports(switch_name, ports)
     return json.dumps(result)
 
 
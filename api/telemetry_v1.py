@@ -0,0 +1,75 @@
+from database.connector import open_session, close_session
+from database.tables import RaspNode
+from lib.influx_writer import write_points
+from lib.telemetry_push import mark_push
+import flask, json, logging, time
+
+
+telemetry_v1 = flask.Blueprint("telemetry_v1", __name__)
+# The InfluxDB points of the telemetry values: { json_key: (measurement, field, type) }
+# The temperatures are written as the temperatures of agent_temperature.py
+TELEMETRY_FIELDS = {
+    "temperature": ("temperature_C", "consumption", int),
+    "load": ("load_avg", "value", float),
+    "memory": ("memory_percent", "value", float)
+}
+# Maximum number of samples in one request
+MAX_SAMPLES = 120
+# Reload the IP of the nodes from the database after this number of seconds
+IP_CACHE_TTL = 60
+# The IP of the nodes used to authenticate the requests: { "ips": { node_name: node_ip }, "loaded_at": timestamp }
+NODE_IPS = { "ips": {}, "loaded_at": 0 }
+
+
+def node_ip(node_name):
+    if time.time() - NODE_IPS["loaded_at"] > IP_CACHE_TTL:
+        db = open_session()
+        NODE_IPS["ips"] = { n.name: n.ip for n in db.query(RaspNode).all() }
+        close_session(db)
+        NODE_IPS["loaded_at"] = time.time()
+    return NODE_IPS["ips"].get(node_name)
+
+
+# Receive the telemetry values from the deployed nodes (see admin/telemetry-push.sh)
+# This route does not use the API token: the request must come from the IP of the node
+@telemetry_v1.route("/push", methods=["POST"])
+def push():
+    """
+    Buffer the telemetry values of a node before writing them to the Influx DB.
+    JSON parameters: 'node', 'samples'.
+    Example of parameters:
+    {
+        'node': 'node-1',
+        'samples': [
+            { 'time': 1612345678, 'temperature': 45, 'load': 0.52, 'memory': 23.4 },
+            { 'time': 1612345679, 'temperature': 46, 'load': 0.48, 'memory': 23.5 }
+        ]
+    }
+    Example of return value:
+    { 'points': 6 }
+    """
+    data = flask.request.json
+    if data is None or "node" not in data or "samples" not in data or not isinstance(data["samples"], list):
+        return json.dumps({ "parameters": "node: 'node-1', samples: [ { 'time': 1612345678, 'temperature': 45 } ]" })
+    node_name = data["node"]
+    if node_ip(node_name) != flask.request.remote_addr:
+        logging.warning("[%s] telemetry from the wrong IP '%s'" % (node_name, flask.request.remote_addr))
+        flask.abort(403)
+    points = []
+    try:
+        for sample in data["samples"][:MAX_SAMPLES]:
+            for key in TELEMETRY_FIELDS:
+                if key in sample:
+                    measurement, field, field_type = TELEMETRY_FIELDS[key]
+                    points.append({
+                        "measurement": measurement,
+                        "tags": { "node": node_name },
+                        "time": int(sample["time"]),
+                        "fields": { field: field_type(sample[key]) }
+                    })
+    except (KeyError, TypeError, ValueError):
+        return json.dumps({ "error": "wrong sample format" })
+    write_points(points, "telemetry")
+    # The temperature agent does not read the temperature of this node with SSH
+    mark_push(node_name)
+    return json.dumps({ "points": len(points) })
@@ -1,5 +1,7 @@
 from cryptography.fernet import Fernet
+from itertools import groupby
 from lib.config_loader import get_config
+import flask, json
 
 # Remove unwanted charaters from the dangerous string
 def safe_string(dangerous_str):
@@ -12,3 +14,72 @@ def decrypt_password(pwd):
         f = Fernet(key)
         return f.decrypt(pwd.encode()).decode()
     return ""
+
+
+# Convert the reservations of a node to one entry per hour: { hour_date: { "owner", "start_hour", "end_hour" } }
+def hourly_schedule(node_res):
+    result = {}
+    for resa in node_res:
+        # Round the end_date up to the next hour
+        remains = resa["end_date"] % 3600
+        if remains == 0:
+            end_date_comp = resa["end_date"]
+        else:
+            end_date_comp = resa["end_date"] - remains + 3600
+        # Iterate over hours between start_date and end_date
+        hours_added = 0
+        while resa["start_date"] + hours_added * 3600 < end_date_comp:
+            new_date = resa["start_date"] + hours_added * 3600
+            result[new_date] = {
+                "owner": resa["owner"],
+                "start_hour": resa["start_date"],
+                "end_hour": resa["end_date"]
+            }
+            hours_added += 1
+    return result
+
+
+# Return the time window of the schedule requests: (start_date, end_date or None)
+# Raise ValueError if the dates are not timestamps
+def schedule_window(arg_dict):
+    try:
+        win_start = int(arg_dict.get("start_date", 0))
+        win_end = arg_dict.get("end_date")
+        if win_end is not None:
+            win_end = int(win_end)
+    except (TypeError, ValueError):
+        raise ValueError("'start_date' and 'end_date' must be timestamps")
+    if win_end is not None and win_end <= win_start:
+        raise ValueError("'end_date' must be greater than 'start_date'")
+    return win_start, win_end
+
+
+# Send the reservations of the nodes as a stream (see node_schedule() in api/user_v1.py)
+# reservations: iterable of (node_name, start_date, end_date, owner) sorted by node_name then start_date, it is
+# read node by node while the response is sent (it can read the reservations from the database)
+def schedule_response(reservations, arg_dict):
+    if arg_dict is None:
+        arg_dict = {}
+    # Keep the reservations of the time window
+    try:
+        win_start, win_end = schedule_window(arg_dict)
+    except ValueError as e:
+        return json.dumps({ "error": str(e) })
+    hourly = arg_dict.get("hourly", False)
+    def generate():
+        yield '{"nodes": {'
+        separator = ""
+        for node_name, node_res in groupby(reservations, key = lambda r: r[0]):
+            intervals = [ { "owner": owner, "start_date": start_date, "end_date": end_date }
+                for _, start_date, end_date, owner in node_res
+                if end_date > win_start and (win_end is None or start_date < win_end) ]
+            if len(intervals) == 0:
+                continue
+            if hourly:
+                node_json = json.dumps(hourly_schedule(intervals))
+            else:
+                node_json = json.dumps(intervals)
+            yield "%s%s: %s" % (separator, json.dumps(str(node_name)), node_json)
+            separator = ", "
+        yield "}}"
+    return flask.Response(generate(), mimetype = "application/json")
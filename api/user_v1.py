@@ -58,7 +58,8 @@ def switch_list():
 def switch_consumption():
     """
     Read the power consumption of the ports of the switch from the Influx DB.
-    JSON parameters: 'period'
+    The values are averaged on a resolution chosen from the period (at most 360 values per port).
+    JSON parameters: 'period' (default: '1h'), 'switch' (optional)
     Example of return value:
     [
         {
@@ -122,8 +123,9 @@ def environment_list():
 @auth
 def node_temperature():
     """
-    Read the power consumption of the ports of the switch from the Influx DB.
-    JSON parameters: 'period'
+    Read the temperature of the nodes from the Influx DB.
+    The values are averaged on a resolution chosen from the period (at most 360 values per node).
+    JSON parameters: 'period' (default: '1h')
     Example of return value:
     [
         {
@@ -162,8 +164,8 @@ def node_state():
                 "os_password": "toto", "optional_prop": "my_value"
             },
             "node-2": {
-                "name": "node-2", "state": "env_check", "bin": "first_bin"
-                "another_optional_prop": "my_value"
+                "name": "node-2", "state": "env_check", "bin": "first_bin",
+                "percent": "42", "copied": 901775360, "total": 2147483648, "eta": 75
             },
             "node-3": {
                 "name": "node-2", "state": "deployed", "bin": "second_bin"
@@ -178,39 +180,21 @@ def node_state():
 @auth
 def node_schedule():
     """
-    Return the list of reservations.
-    JSON parameters: none.
+    Return the reservations of the nodes, one interval per reservation. The response is streamed node by node.
+    JSON parameters (optional): 'start_date' and 'end_date' (timestamps, otherwise { 'error': msg } is returned)
+    to only get the reservations of this time window,
+    'hourly': true to get one entry per hour of the reservations: { 'nodes': { 'node-5': { hour_date: {
+    'owner': 'admin@piseduce.fr', 'start_hour': 1622452140, 'end_hour': 1622466540 } } } }
     Example of return value:
     {
         'nodes': {
-            'node-5': {
-                '2021-05-31': {
-                    'admin@piseduce.fr': {
-                        'hours': ['9', '10', '11', '12', '13'],
-                        'owner': 'admin@piseduce.fr',
-                        'start_hour': '09:09:00',
-                        'end_hour': '13:09:00'
-                    }
-                }
-            },
-            'node-3': {
-                '2021-05-31': {
-                    'admin@piseduce.fr': {
-                        'hours': ['21', '22', '23'],
-                        'owner': 'admin@piseduce.fr',
-                        'start_hour': '21:18:00',
-                        'end_hour': '01:18:00'
-                    }
-                },
-                '2021-06-01': {
-                    'admin@piseduce.fr': {
-                        'hours': ['0', '1'],
-                        'owner': 'admin@piseduce.fr',
-                        'start_hour': '21:18:00',
-                        'end_hour': '01:18:00'
-                    }
-                }
-            }
+            'node-5': [
+                { 'owner': 'admin@piseduce.fr', 'start_date': 1622452140, 'end_date': 1622466540 }
+            ],
+            'node-3': [
+                { 'owner': 'admin@piseduce.fr', 'start_date': 1622488680, 'end_date': 1622503080 },
+                { 'owner': 'user@piseduce.fr', 'start_date': 1622534400, 'end_date': 1622548800 }
+            ]
         }
     }
     """
@@ -1,10 +1,30 @@
 from lib.config_loader import get_config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 DB_URL = get_config()["db_url"]
+# Pragmas applied to every SQLite connection, they can be overridden by 'sqlite_pragmas' in config_agent.json
+# The WAL journal allows the readers (API, power, temperature) to run during the writes of the executor
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 10000,
+    "cache_size": -16000,
+    "mmap_size": 67108864
+}
 
 engine = create_engine(DB_URL, connect_args = {"check_same_thread": False} )
 SessionLocal = sessionmaker(autocommit = False, autoflush = False, bind = engine)
 Base = declarative_base()
+
+
+if DB_URL.startswith("sqlite"):
+    pragmas = dict(SQLITE_PRAGMAS)
+    pragmas.update(get_config().get("sqlite_pragmas", {}))
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name in pragmas:
+            cursor.execute("PRAGMA %s = %s" % (name, pragmas[name]))
+        cursor.close()
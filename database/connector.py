@@ -1,8 +1,12 @@
 from database.base import Base, DB_URL, engine, SessionLocal
-from sqlalchemy import inspect
+from database.tables import ActionProperty, NodeConf, Schedule
+from sqlalchemy import Integer, inspect, text
 # Import tables to load the table description
 import database.tables, logging
 
+# The node properties stored in the columns of the NodeConf table
+NODE_CONF_PROPS = [ col.name for col in NodeConf.__table__.columns if col.name not in [ "node_name", "owner" ] ]
+
 
 def open_session():
     return SessionLocal()
@@ -28,3 +32,83 @@ def create_tables():
         Base.metadata.create_all(engine)
         return True
     return False
+
+
+# Add the missing tables, columns and indexes to the database created by an older version of the agent
+def upgrade_tables():
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            logging.info("Create the table '%s'" % table.name)
+            table.create(engine)
+        else:
+            existing_cols = [ col["name"] for col in inspector.get_columns(table.name) ]
+            for col in table.columns:
+                if col.name not in existing_cols:
+                    logging.info("Add the column '%s' to the table '%s'" % (col.name, table.name))
+                    col_type = col.type.compile(engine.dialect)
+                    with engine.begin() as connection:
+                        connection.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                            table.name, col.name, col_type)))
+            existing_indexes = [ idx["name"] for idx in inspector.get_indexes(table.name) ]
+            for idx in table.indexes:
+                if idx.name not in existing_indexes:
+                    logging.info("Create the index '%s' on the table '%s'" % (idx.name, table.name))
+                    idx.create(engine)
+
+
+# Move the node properties stored in the ActionProperty table by older versions of the agent to the NodeConf table
+def migrate_properties():
+    db = open_session()
+    confs = { conf.node_name: conf for conf in db.query(NodeConf).all() }
+    props = db.query(ActionProperty).filter(ActionProperty.prop_name.in_(NODE_CONF_PROPS)).all()
+    for prop in props:
+        if prop.node_name not in confs:
+            conf = NodeConf()
+            conf.node_name = prop.node_name
+            conf.owner = prop.owner
+            db.add(conf)
+            confs[prop.node_name] = conf
+        value = prop.prop_value
+        if isinstance(NodeConf.__table__.columns[prop.prop_name].type, Integer):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = None
+        setattr(confs[prop.node_name], prop.prop_name, value)
+        db.delete(prop)
+    close_session(db)
+    if len(props) > 0:
+        logging.info("Move %d action properties to the node_conf table" % len(props))
+    return len(props)
+
+
+# Return the NodeConf row of the executor context (see agent_exec.load_context()), create it if it does not exist
+def context_conf(db, ctx, node_name):
+    if node_name not in ctx["confs"]:
+        ctx["confs"][node_name] = get_node_conf(db, node_name)
+    return ctx["confs"][node_name]
+
+
+# Return the property of the NodeConf row of the executor context, 'default' if the property is not set
+def context_conf_value(ctx, node_name, prop_name, default = None):
+    node_conf = ctx["confs"].get(node_name)
+    if node_conf is None or getattr(node_conf, prop_name) is None:
+        return default
+    return getattr(node_conf, prop_name)
+
+
+# Return the configuration of the node, a new configuration is added to the session if it does not exist
+def get_node_conf(db, node_name, owner = None):
+    conf = db.query(NodeConf).filter(NodeConf.node_name == node_name).first()
+    if conf is None:
+        if owner is None:
+            reservation = db.query(Schedule).filter(Schedule.node_name == node_name).first()
+            if reservation is not None:
+                owner = reservation.owner
+        conf = NodeConf()
+        conf.node_name = node_name
+        conf.owner = owner
+        db.add(conf)
+    return conf
@@ -1,5 +1,5 @@
 from database.base import Base
-from sqlalchemy import Boolean, Column, Integer, String, Text
+from sqlalchemy import Boolean, Column, Index, Integer, String, Text
 
 
 # Common tables for all agent types (raspberry, g5k, iot-lab)
@@ -9,9 +9,13 @@ class Action(Base):
     node_ip = Column(Text)
     environment = Column(Text)
     process = Column(Text)
-    state = Column(String(120))
+    state = Column(String(120), index=True)
     state_idx = Column(Integer)
     updated_at = Column(Integer)
+    # Date of the next execution of the state function (None: as soon as possible)
+    next_run = Column(Integer)
+    # Number of consecutive failures of the current state function (used to compute next_run)
+    failures = Column(Integer)
 
 
     def __repr__(self):
@@ -20,6 +24,7 @@ class Action(Base):
 
 class ActionProperty(Base):
     __tablename__ = 'action_prop'
+    # The queries on (node_name, prop_name) use the primary key index: do not change the column order
     node_name = Column(Text, primary_key=True)
     prop_name = Column(Text, primary_key=True)
     prop_value = Column(Text)
@@ -30,15 +35,46 @@ class ActionProperty(Base):
         return "action_prop(%s, %s, %s)" % (self.node_name, self.prop_name, self.prop_value)
 
 
+# Configuration of the reserved nodes (one row per node, the other properties are stored in ActionProperty)
+class NodeConf(Base):
+    __tablename__ = 'node_conf'
+    node_name = Column(Text, primary_key=True)
+    owner = Column(Text)
+    # Properties from the configure panel
+    environment = Column(Text)
+    part_size = Column(Text)
+    os_password = Column(Text)
+    form_ssh_key = Column(Text)
+    account_ssh_key = Column(Text)
+    ssh_key = Column(Text)
+    # Properties written by the executor
+    percent = Column(Integer)
+    reboot_state = Column(Text)
+    deployment = Column(Text)
+    # Properties of the 'reg_env' process
+    img_path = Column(Text)
+    env_name = Column(Text)
+    # Properties of the g5k reservations
+    g5k = Column(Text)
+    assigned_nodes = Column(Text)
+
+
+    def __repr__(self):
+        return "node_conf(%s, %s, %s)" % (self.node_name, self.environment, self.reboot_state)
+
+
 class Schedule(Base):
     __tablename__ = 'schedule'
+    # The primary key index is only used by the queries on node_name, add an index for the queries on owner
     node_name = Column(Text, primary_key=True)
-    owner = Column(Text, primary_key=True)
+    owner = Column(Text, primary_key=True, index=True)
     bin = Column(Text)
     start_date = Column(Integer)
-    end_date = Column(Integer)
+    end_date = Column(Integer, index=True)
     state = Column(Text)
     action_state = Column(Text)
+    # Used by the executor to find the reservations to deploy
+    __table_args__ = (Index("ix_schedule_state_action_state", "state", "action_state", "start_date"),)
 
 
     def __repr__(self):
@@ -1,10 +1,14 @@
-from api.tool import safe_string, decrypt_password
-from database.connector import open_session, close_session
-from database.tables import Action, ActionProperty, Schedule
+from api.tool import safe_string, decrypt_password, schedule_response
+from database.connector import open_session, close_session, get_node_conf
+from database.tables import Action, ActionProperty, NodeConf, Schedule
 from datetime import datetime, timedelta, timezone
-from grid5000 import Grid5000
+from g5k.client import connect_site, invalidate_lists, list_jobs, site_status
 from importlib import import_module
+from lib.availability import index_reservations, select_nodes
 from lib.config_loader import get_config
+from lib.fanout import parallel_calls, parallel_map
+from lib.inventory import get_servers
+from lib.notify import notify_executor
 from agent_exec import free_reserved_node, new_action, init_action_process, save_reboot_state
 import json, logging, os, pytz, requests, time
 
@@ -16,10 +20,32 @@ CONFIGURE_PROP = {
 
 
 def g5k_connect(args):
-    return Grid5000(
-        username = args["g5k_user"],
-        password = decrypt_password(args["g5k_password"])
-    ).sites[get_config()["g5k_site"]]
+    return connect_site(args["g5k_user"], args["g5k_password"])
+
+
+# Get the running and the waiting jobs of the grid5000 user with concurrent requests (the results are cached)
+def list_user_jobs(args):
+    running_jobs, waiting_jobs = parallel_calls(
+        lambda: list_jobs(args["g5k_user"], args["g5k_password"], "running"),
+        lambda: list_jobs(args["g5k_user"], args["g5k_password"], "waiting"))
+    return running_jobs + waiting_jobs
+
+
+def refresh_job(job):
+    job.refresh()
+    return job
+
+
+# Wait for the start date of the job during 'g5k_start_wait' seconds, return None if the job is not started
+# The waiting jobs must not hold the threads of the fanout pool shared by all the requests
+def wait_job_start(job):
+    deadline = time.time() + get_config().get("g5k_start_wait", 10)
+    while job.started_at == 0:
+        if time.time() > deadline:
+            return None
+        job.refresh()
+        time.sleep(1)
+    return job
 
 
 # Delete the jobs existing in the schedule but not in the g5k API
@@ -48,41 +74,39 @@ def delete_job(db_job, db):
     # Delete the action properties associated to this job
     for a in db.query(ActionProperty).filter(ActionProperty.node_name == db_job.node_name).all():
         db.delete(a)
+    for c in db.query(NodeConf).filter(NodeConf.node_name == db_job.node_name).all():
+        db.delete(c)
     # Delete the job from the Schedule table
     db.delete(db_job)
 
 
+# Return the server list from memory (the list is rebuilt every 'inventory_ttl' seconds)
 def build_server_list(g5k_site):
-    # The file to build the server list without querying the grid5000 API
-    server_file = "node-g5k.json"
-    # Get all nodes in the default queue of this site
+    return get_servers("node-g5k.json", lambda: query_server_list(g5k_site))
+
+
+# Get all nodes in the default queue of this site from the grid5000 API
+def query_server_list(g5k_site):
     servers = {}
-    if os.path.isfile(server_file):
-        with open(server_file, "r") as f:
-            servers = json.load(f)
-    else:
-        # List all nodes of the site
-        logging.info("Query the API to build the server list")
-        for cl in g5k_site.clusters.list():
-            for node in g5k_site.clusters[cl.uid].nodes.list():
-                if "default" in node.supported_job_types["queues"]:
-                    servers[node.uid] = {
-                        "name": node.uid,
-                        "site": g5k_site.uid,
-                        "cluster": cl.uid,
-                        "cpu_nb": str(node.architecture["nb_threads"]),
-                        "memoryMB": str(node.main_memory["ram_size"] / 1024 / 1024 / 1024),
-                        "model": node.chassis["name"]
-                    }
-        # Remove dead servers
-        nodes = g5k_site.status.list().nodes
-        for node  in nodes:
-            node_name = node.split(".")[0]
-            if node_name in servers:
-                if nodes[node]["hard"] == "dead":
-                    del servers[node_name]
-        with open(server_file, "w") as f:
-            f.write(json.dumps(servers, indent = 4))
+    # List all nodes of the site
+    for cl in g5k_site.clusters.list():
+        for node in g5k_site.clusters[cl.uid].nodes.list():
+            if "default" in node.supported_job_types["queues"]:
+                servers[node.uid] = {
+                    "name": node.uid,
+                    "site": g5k_site.uid,
+                    "cluster": cl.uid,
+                    "cpu_nb": str(node.architecture["nb_threads"]),
+                    "memoryMB": str(node.main_memory["ram_size"] / 1024 / 1024 / 1024),
+                    "model": node.chassis["name"]
+                }
+    # Remove dead servers
+    nodes = g5k_site.status.list().nodes
+    for node  in nodes:
+        node_name = node.split(".")[0]
+        if node_name in servers:
+            if nodes[node]["hard"] == "dead":
+                del servers[node_name]
     return servers
 
 
@@ -157,19 +181,14 @@ def node_configure(arg_dict):
     db = open_session()
     schedule = db.query(Schedule).filter(Schedule.owner == arg_dict["user"]).all()
     uids = { sch.node_name: sch for sch in schedule}
-    # Connect to the grid5000 API
-    g5k_site = g5k_connect(arg_dict)
     # Get the grid5000 jobs for the grid5000 user
-    user_jobs = g5k_site.jobs.list(state = "running", user = arg_dict["g5k_user"])
-    user_jobs += g5k_site.jobs.list(state = "waiting", user = arg_dict["g5k_user"])
+    user_jobs = list_user_jobs(arg_dict)
     # Deleted jobs that do not exist anymore
     check_deleted_jobs(uids, user_jobs, db)
+    # Wait for the start_date of all jobs at the same time, the jobs not started yet are configured later
+    user_jobs = [ j for j in parallel_map(wait_job_start, user_jobs) if j is not None ]
     # Add the unregistered grid5000 jobs to the DB
     for j in user_jobs:
-        # Wait for the start_date
-        while j.started_at == 0:
-            j.refresh()
-            time.sleep(1)
         job_id = str(j.uid)
         if job_id in uids:
             schedule = uids[job_id]
@@ -242,24 +261,16 @@ def node_deploy(arg_dict):
             else:
                 my_job.bin = node_bin
                 my_job.state = "ready"
-                env = ActionProperty()
-                env.owner = arg_dict["user"]
-                env.node_name = my_job.node_name
-                env.prop_name = "environment"
-                env.prop_value = my_prop["environment"]
-                db.add(env)
-                ssh_key = ActionProperty()
-                ssh_key.owner = arg_dict["user"]
-                ssh_key.node_name = my_job.node_name
-                ssh_key.prop_name = "ssh_key"
+                node_conf = get_node_conf(db, my_job.node_name, arg_dict["user"])
+                node_conf.environment = my_prop["environment"]
                 if "form_ssh_key" in my_prop and len(my_prop["form_ssh_key"]) > 0:
-                    ssh_key.prop_value = my_prop["form_ssh_key"]
-                    db.add(ssh_key)
+                    node_conf.ssh_key = my_prop["form_ssh_key"]
                 elif "account_ssh_key" in my_prop and len(my_prop["account_ssh_key"]) > 0:
-                    ssh_key.prop_value = my_prop["account_ssh_key"]
-                    db.add(ssh_key)
+                    node_conf.ssh_key = my_prop["account_ssh_key"]
                 close_session(db)
                 result[node_name] = { "state": "ready" }
+    # Wake up the executor to process the modifications
+    notify_executor()
     return json.dumps(result)
 
 
@@ -299,6 +310,8 @@ def node_deployagain(arg_dict):
         else:
             result[n.node_name] = "failure: %s is not ready" % n.node_name
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -340,6 +353,8 @@ def node_destroy(arg_dict):
         db.add(node_action)
         result[n.node_name] = "success"
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -369,13 +384,13 @@ def node_extend(arg_dict):
             ).filter(Schedule.node_name.in_(wanted)
             ).filter(Schedule.owner == user
             ).all()
+    g5k_login = (arg_dict["g5k_user"], decrypt_password(arg_dict["g5k_password"]))
     for n in nodes:
         # Allow users to extend their reservation 4 hours before the end_date
         if n.end_date - int(time.time()) < 4 * 3600:
             hours_added = int((n.end_date - n.start_date) / 3600)
             api_url = "https://api.grid5000.fr/stable/sites/%s/internal/oarapi/jobs/%s.json" % (
                 get_config()["g5k_site"], n.node_name)
-            g5k_login = (arg_dict["g5k_user"], decrypt_password(arg_dict["g5k_password"]))
             json_data = {"method":"walltime-change", "walltime":"+%d:00" % hours_added }
             r = requests.post(url = api_url, auth = g5k_login, json = json_data)
             if r.status_code == 202:
@@ -438,13 +453,13 @@ def node_mine(arg_dict):
     if len(db_jobs) == 0:
         close_session(db)
         return json.dumps(result)
-    # Connect to the grid5000 API
-    g5k_site = g5k_connect(arg_dict)
-    user_jobs = g5k_site.jobs.list(state = "running", user = arg_dict["g5k_user"])
-    user_jobs += g5k_site.jobs.list(state = "waiting", user = arg_dict["g5k_user"])
+    # Get the grid5000 jobs for the grid5000 user
+    user_jobs = list_user_jobs(arg_dict)
     check_deleted_jobs(db_jobs, user_jobs, db)
+    confs = { c.node_name: c for c in db.query(NodeConf).filter(NodeConf.node_name.in_(db_jobs.keys())).all() }
+    # Refresh the jobs with concurrent requests
+    parallel_map(refresh_job, user_jobs)
     for j in user_jobs:
-        j.refresh()
         uid_str = str(j.uid)
         if uid_str in db_jobs:
             my_conf = db_jobs[uid_str]
@@ -456,21 +471,13 @@ def node_mine(arg_dict):
                 "state": my_conf.state,
                 "job_state": j.state
             }
-            assigned_nodes = db.query(ActionProperty
-                ).filter(ActionProperty.node_name == my_conf.node_name
-                ).filter(ActionProperty.prop_name == "assigned_nodes"
-                ).first()
-            if assigned_nodes is None:
-                if len(j.assigned_nodes) > 0:
-                    assigned_nodes = ActionProperty()
-                    assigned_nodes.owner = arg_dict["user"]
-                    assigned_nodes.node_name = my_conf.node_name
-                    assigned_nodes.prop_name = "assigned_nodes"
-                    assigned_nodes.prop_value = ",".join(j.assigned_nodes)
-                    db.add(assigned_nodes)
-                    result["nodes"][uid_str]["assigned_nodes"] = assigned_nodes.prop_value
-            else:
-                result["nodes"][uid_str]["assigned_nodes"] = assigned_nodes.prop_value
+            node_conf = confs.get(my_conf.node_name)
+            if (node_conf is None or node_conf.assigned_nodes is None) and len(j.assigned_nodes) > 0:
+                if node_conf is None:
+                    node_conf = get_node_conf(db, my_conf.node_name, arg_dict["user"])
+                node_conf.assigned_nodes = ",".join(j.assigned_nodes)
+            if node_conf is not None and node_conf.assigned_nodes is not None:
+                result["nodes"][uid_str]["assigned_nodes"] = node_conf.assigned_nodes
     close_session(db)
     return json.dumps(result)
 
@@ -522,31 +529,14 @@ def node_reserve(arg_dict):
                     filtered_nodes.append(node["name"])
     # Check the availability of the filtered nodes
     logging.info("Filtered nodes: %s" % filtered_nodes)
-    selected_nodes = []
-    node_status = {}
-    for node_name in filtered_nodes:
-        cluster_name = node_name.split("-")[0]
-        if cluster_name not in node_status:
-            node_status[cluster_name] = status_to_reservations(g5k_site.clusters[cluster_name].status.list().nodes)
-        ok_selected = True
-        # Move the start date back 15 minutes to give the time for destroying the previous reservation
-        back_date = start_date - 15 * 60
-        # Check the schedule of the existing reservations
-        if node_name in node_status[cluster_name]:
-            for reservation in node_status[cluster_name][node_name]:
-                # Only one reservation for a specific node per user
-                if reservation["owner"] == user:
-                    ok_selected = False
-                # There is no reservation at the same date
-                if (back_date > reservation["start_date"] and back_date < reservation["end_date"]) or (
-                    back_date < reservation["start_date"] and end_date > reservation["start_date"]):
-                    ok_selected = False
-        if ok_selected:
-            # Add the node to the reservation
-            selected_nodes.append(node_name)
-            if len(selected_nodes) == nb_nodes:
-                # Exit when the required number of nodes is reached
-                break;
+    # Get the status of the clusters of the filtered nodes with concurrent requests
+    cluster_names = sorted(set([ node_name.split("-")[0] for node_name in filtered_nodes ]))
+    reservations = {}
+    for cluster_status in parallel_map(
+        lambda cl: status_to_reservations(g5k_site.clusters[cl].status.list().nodes), cluster_names):
+        reservations.update(cluster_status)
+    selected_nodes = select_nodes(index_reservations(reservations), filtered_nodes, nb_nodes,
+        start_date, end_date, user)
     logging.info("Selected nodes: %s" % selected_nodes)
     # Set the duration of the job
     walltime = "%s:00" % arg_dict["duration"]
@@ -582,15 +572,12 @@ def node_reserve(arg_dict):
         job_conf["properties"] = "(cluster in (%s))" % ",".join(["'%s'" % c for c in clusters])
     try:
         job = g5k_site.jobs.create(job_conf)
+        invalidate_lists(arg_dict["g5k_user"])
         result["nodes"] = selected_nodes
         # Store the g5k login/password to the DB in order to use it with agent_exec.py
         db = open_session()
-        g5k_cred = ActionProperty()
-        g5k_cred.node_name = job.uid
-        g5k_cred.owner = arg_dict["user"]
-        g5k_cred.prop_name = "g5k"
-        g5k_cred.prop_value = "%s/%s" % (arg_dict["g5k_user"], arg_dict["g5k_password"])
-        db.add(g5k_cred)
+        node_conf = get_node_conf(db, str(job.uid), arg_dict["user"])
+        node_conf.g5k = "%s/%s" % (arg_dict["g5k_user"], arg_dict["g5k_password"])
         close_session(db)
     except:
         logging.exception("Creating job: ")
@@ -598,34 +585,16 @@ def node_reserve(arg_dict):
 
 
 def node_schedule(arg_dict):
-    result = { "nodes": {} }
     # Connect to the grid5000 API
     g5k_site = g5k_connect(arg_dict)
-    # Get the list of servers
-    servers = build_server_list(g5k_site)
-    reservations = status_to_reservations(g5k_site.status.list().nodes)
-    for node_name in reservations:
+    # Get the list of servers and the status of the site at the same time
+    servers, node_status = parallel_calls(lambda: build_server_list(g5k_site),
+        lambda: site_status(arg_dict["g5k_user"], arg_dict["g5k_password"]))
+    reservations = []
+    for node_name, node_res in status_to_reservations(node_status).items():
         if node_name in servers:
-            if node_name not in result["nodes"]:
-                result["nodes"][node_name] = {}
-            for resa in reservations[node_name]:
-                # Round the end_date up to the next hour
-                remains = resa["end_date"] % 3600
-                if remains == 0:
-                    end_date_comp = resa["end_date"]
-                else:
-                    end_date_comp = resa["end_date"] - remains + 3600
-                # Iterate over hours between start_date and end_date
-                hours_added = 0
-                while resa["start_date"] + hours_added * 3600 < end_date_comp:
-                    new_date = resa["start_date"] + hours_added * 3600
-                    result["nodes"][node_name][new_date] = {
-                        "owner": resa["owner"],
-                        "start_hour": resa["start_date"],
-                        "end_hour": resa["end_date"]
-                    }
-                    hours_added += 1
-    return json.dumps(result)
+            reservations += [ (node_name, r["start_date"], r["end_date"], r["owner"]) for r in node_res ]
+    return schedule_response(sorted(reservations, key = lambda r: (r[0], r[1])), arg_dict)
 
 
 def node_state(arg_dict):
@@ -635,11 +604,8 @@ def node_state(arg_dict):
     # Get the jobs in the schedule by reading the DB
     schedule = db.query(Schedule).filter(Schedule.owner == arg_dict["user"]).all()
     uids = { sch.node_name: sch for sch in schedule}
-    # Connect to the grid5000 API
-    g5k_site = g5k_connect(arg_dict)
     # Get the grid5000 jobs for the grid5000 user
-    user_jobs = g5k_site.jobs.list(state = "running", user = arg_dict["g5k_user"])
-    user_jobs += g5k_site.jobs.list(state = "waiting", user = arg_dict["g5k_user"])
+    user_jobs = list_user_jobs(arg_dict)
     # Deleted jobs that do not exist anymore
     check_deleted_jobs(uids, user_jobs, db)
     # Get the jobs in the schedule
@@ -0,0 +1,78 @@
+from api.tool import decrypt_password
+from grid5000 import Grid5000
+from lib.config_loader import get_config
+import threading, time
+
+# Lifetime in seconds of the grid5000 clients (the HTTP sessions are reused during this time)
+CLIENT_TTL = 3600
+# The grid5000 sites of the users: { (g5k_user, encrypted_password): (expiration_date, site) }
+CLIENTS = {}
+# The results of the list requests: { (g5k_user, encrypted_password, list_name, state): (expiration_date, result) }
+LISTS = {}
+CACHE_LOCK = threading.Lock()
+
+
+def list_ttl():
+    # Lifetime in seconds of the results of the list requests (jobs, deployments, status)
+    return get_config().get("g5k_list_ttl", 5)
+
+
+def remove_expired(cache, now):
+    for key in [ k for k, v in cache.items() if v[0] <= now ]:
+        del cache[key]
+
+
+# Return the grid5000 site of the configuration from a client reused by the requests of the same user
+def connect_site(g5k_user, encrypted_pwd):
+    key = (g5k_user, encrypted_pwd)
+    with CACHE_LOCK:
+        cached = CLIENTS.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    site = Grid5000(
+        username = g5k_user,
+        password = decrypt_password(encrypted_pwd)
+    ).sites[get_config()["g5k_site"]]
+    with CACHE_LOCK:
+        now = time.time()
+        remove_expired(CLIENTS, now)
+        CLIENTS[key] = (now + CLIENT_TTL, site)
+    return site
+
+
+# Return the result of the list request from the cache or from the grid5000 API
+def cached_list(g5k_user, encrypted_pwd, list_name, state, list_fct):
+    key = (g5k_user, encrypted_pwd, list_name, state)
+    with CACHE_LOCK:
+        cached = LISTS.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    result = list_fct(connect_site(g5k_user, encrypted_pwd))
+    with CACHE_LOCK:
+        now = time.time()
+        remove_expired(LISTS, now)
+        LISTS[key] = (now + list_ttl(), result)
+    return result
+
+
+# Return the jobs of the user in the state ('running' or 'waiting')
+def list_jobs(g5k_user, encrypted_pwd, state):
+    return cached_list(g5k_user, encrypted_pwd, "jobs", state,
+        lambda site: list(site.jobs.list(state = state, user = g5k_user)))
+
+
+def list_deployments(g5k_user, encrypted_pwd):
+    return cached_list(g5k_user, encrypted_pwd, "deployments", None,
+        lambda site: list(site.deployments.list(user = g5k_user)))
+
+
+# Return the status of the nodes of the site
+def site_status(g5k_user, encrypted_pwd):
+    return cached_list(g5k_user, encrypted_pwd, "status", None, lambda site: site.status.list().nodes)
+
+
+# Forget the list results of the user after the creation or the deletion of jobs and deployments
+def invalidate_lists(g5k_user):
+    with CACHE_LOCK:
+        for key in [ k for k in LISTS if k[0] == g5k_user ]:
+            del LISTS[key]
@@ -1,72 +1,49 @@
-from api.tool import decrypt_password
-from database.tables import ActionProperty
-from grid5000 import Grid5000
-from lib.config_loader import get_config
+from database.connector import context_conf, context_conf_value
+from g5k.client import connect_site, invalidate_lists, list_deployments, list_jobs
 import logging
 
 
-def g5k_connect(action, db):
-    credential = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == action.node_name
-        ).filter(ActionProperty.prop_name == "g5k").first()
-    user = credential.prop_value.split("/", 1)[0]
-    pwd = credential.prop_value.split("/", 1)[1]
-    return (Grid5000(
-        username = user,
-        password = decrypt_password(pwd)
-    ).sites[get_config()["g5k_site"]], user)
+# Return the grid5000 user and the encrypted password of the job
+def g5k_credential(action, ctx):
+    credential = ctx["confs"][action.node_name].g5k
+    return credential.split("/", 1)[0], credential.split("/", 1)[1]
 
 
-def wait_running_post(action, db):
-    g5k_info = g5k_connect(action, db)
-    g5k_site = g5k_info[0]
-    g5k_user = g5k_info[1]
-    for j in g5k_site.jobs.list(state="running", user = g5k_user):
+def g5k_connect(action, ctx):
+    user, pwd = g5k_credential(action, ctx)
+    return (connect_site(user, pwd), user)
+
+
+def wait_running_post(action, db, ctx):
+    # The job lists are shared by the jobs of the same user
+    g5k_user, g5k_pwd = g5k_credential(action, ctx)
+    for j in list_jobs(g5k_user, g5k_pwd, "running"):
         if str(j.uid) == action.node_name:
             return True
     return False
 
 
-def deploy_exec(action, db):
-    g5k_info = g5k_connect(action, db)
+def deploy_exec(action, db, ctx):
+    g5k_info = g5k_connect(action, ctx)
     g5k_site = g5k_info[0]
-    g5k_user = g5k_info[1]
-    for j in g5k_site.jobs.list(state="running", user = g5k_user):
+    g5k_user, g5k_pwd = g5k_credential(action, ctx)
+    for j in list_jobs(g5k_user, g5k_pwd, "running"):
         if str(j.uid) == action.node_name:
             j.refresh()
             if len(j.assigned_nodes) > 0:
-                env = db.query(ActionProperty
-                    ).filter(ActionProperty.node_name == action.node_name
-                    ).filter(ActionProperty.prop_name == "environment"
-                    ).first()
-                ssh_key = db.query(ActionProperty
-                    ).filter(ActionProperty.node_name == action.node_name
-                    ).filter(ActionProperty.prop_name == "ssh_key"
-                    ).first()
-                old_dep = db.query(ActionProperty
-                    ).filter(ActionProperty.node_name == action.node_name
-                    ).filter(ActionProperty.prop_name == "deployment"
-                    ).first()
-                logging.info("[%s] deploy the environment '%s'" % (action.node_name, env.prop_value))
+                node_conf = context_conf(db, ctx, action.node_name)
+                logging.info("[%s] deploy the environment '%s'" % (action.node_name, node_conf.environment))
                 deployment_conf = {
                     "nodes": j.assigned_nodes,
-                    "environment": env.prop_value
+                    "environment": node_conf.environment
                 }
-                if ssh_key is not None and len(ssh_key.prop_value) > 0:
-                    deployment_conf["key"] = ssh_key.prop_value
+                if node_conf.ssh_key is not None and len(node_conf.ssh_key) > 0:
+                    deployment_conf["key"] = node_conf.ssh_key
                 try:
                     dep = g5k_site.deployments.create(deployment_conf)
-                    if old_dep is None:
-                        # Create an action property to register the deployment UID
-                        uid_prop = ActionProperty()
-                        uid_prop.node_name = action.node_name
-                        uid_prop.prop_name = "deployment"
-                        uid_prop.prop_value = dep.uid
-                        uid_prop.owner = env.owner
-                        db.add(uid_prop)
-                    else:
-                        # Update the deployment UID (node_deployagain probably happens)
-                        old_dep.prop_value = dep.uid
+                    invalidate_lists(g5k_user)
+                    # Register the deployment UID (replace the previous one if node_deployagain happens)
+                    node_conf.deployment = dep.uid
                     return True
                 except:
                     logging.exception("Deployment error: ")
@@ -74,35 +51,28 @@ def deploy_exec(action, db):
     return False
 
 
-def wait_deploying_post(action, db):
-    dep_uid = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == action.node_name
-        ).filter(ActionProperty.prop_name == "deployment"
-        ).first()
+def wait_deploying_post(action, db, ctx):
+    dep_uid = context_conf_value(ctx, action.node_name, "deployment")
     if dep_uid is None:
         logging.error("[%s] No deployment UID" % action.node_name)
         return False
-    g5k_info = g5k_connect(action, db)
-    g5k_site = g5k_info[0]
-    g5k_user = g5k_info[1]
-    for d in g5k_site.deployments.list(user = g5k_user):
-        if d.uid == dep_uid.prop_value:
+    g5k_user, g5k_pwd = g5k_credential(action, ctx)
+    for d in list_deployments(g5k_user, g5k_pwd):
+        if d.uid == dep_uid:
             return d.status == "terminated"
-    logging.error("No deployment with the UUID %s" % deployment)
+    logging.error("No deployment with the UUID %s" % dep_uid)
     return False
 
 
-def destroying_exec(action, db):
-    g5k_info = g5k_connect(action, db)
-    g5k_site = g5k_info[0]
-    g5k_user = g5k_info[1]
+def destroying_exec(action, db, ctx):
+    g5k_user, g5k_pwd = g5k_credential(action, ctx)
     # Get the jobs of the user
-    user_jobs = g5k_site.jobs.list(state = "running", user = g5k_user)
-    user_jobs += g5k_site.jobs.list(state = "waiting", user = g5k_user)
+    user_jobs = list_jobs(g5k_user, g5k_pwd, "running") + list_jobs(g5k_user, g5k_pwd, "waiting")
     for job in user_jobs:
         uid_str = str(job.uid)
         if uid_str == action.node_name:
             logging.info("[%s] delete this job" % uid_str)
             job.delete()
+            invalidate_lists(g5k_user)
             return True
     return False
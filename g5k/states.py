@@ -52,11 +52,15 @@ PROCESS = {
 # State names must NOT include '_exec' or '_post'
 # 'lost' timeouts must be greater then 'before_reboot' timeouts
 # 0: infinite timeouts
+# Optional polling keys for the states that fail until a condition is met (default: every POLL_INTERVAL seconds):
+#   'poll': delay in seconds before the next execution of a failed state
+#   'backoff': the delay is multiplied by this factor after every failure
+#   'max_poll': the maximum delay in seconds between two executions
 # The states must be ordered according to the process values
 STATE_DESC = {
-    'wait_running': { 'exec': False, 'post': True, 'before_reboot': 0, 'lost': 0 },
+    'wait_running': { 'exec': False, 'post': True, 'before_reboot': 0, 'lost': 0, 'poll': 10, 'backoff': 2, 'max_poll': 120 },
     'deploy': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 0 },
-    'wait_deploying': { 'exec': False, 'post': True, 'before_reboot': 0, 'lost': 0 },
+    'wait_deploying': { 'exec': False, 'post': True, 'before_reboot': 0, 'lost': 0, 'poll': 15, 'backoff': 1.5, 'max_poll': 60 },
     # Final state: exec is False, post is False and the 2 timeouts are infinite (0)
     'deployed': { 'exec': False, 'post': False, 'before_reboot': 0, 'lost': 0 },
 
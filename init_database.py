@@ -9,7 +9,7 @@ if len(sys.argv) != 2:
 load_config(sys.argv[1])
 
 from database.base import DB_URL
-from database.connector import create_tables
+from database.connector import create_tables, migrate_properties, upgrade_tables
 import logging
 
 logging.basicConfig(level=logging.INFO,
@@ -18,4 +18,7 @@ logging.info("Create the tables from the URL '%s'" % DB_URL)
 if create_tables():
     logging.info("Database initialization complete")
 else:
-    logging.error("Fail to initialize the database")
+    logging.info("The database already exists. Upgrade the tables...")
+    upgrade_tables()
+    migrate_properties()
+    logging.info("Database upgrade complete")
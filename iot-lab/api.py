@@ -1,11 +1,14 @@
-from api.tool import safe_string, decrypt_password
+from api.tool import safe_string, decrypt_password, schedule_response
 from database.connector import open_session, close_session
 from database.tables import IotNodes, IotSelection, Schedule
 from datetime import datetime
 from glob import glob
 from importlib import import_module
+from lib.availability import index_reservations, select_nodes
 from lib.config_loader import get_config
-import json, logging, os, pytz, subprocess, time
+from lib.fanout import parallel_map
+from lib.inventory import get_servers
+import json, logging, os, pytz, subprocess, threading, time
 
 
 # The required properties to configure the iot-lab nodes from the configure panel
@@ -13,28 +16,45 @@ CONFIGURE_PROP = {
     "firmware": { "values": [], "mandatory": False },
     "profile": { "values": [], "mandatory": False }
 }
-
-
+# The last reservations read from the IoT-Lab plateform: { "reservations": { node_name: [] }, "loaded_at": timestamp }
+EXPERIMENTS = { "reservations": {}, "loaded_at": 0 }
+EXPERIMENTS_LOCK = threading.Lock()
+
+
+# Get the reservations of the IoT-Lab plateform indexed by node name (the result is reused for a few seconds)
+def platform_reservations():
+    # The concurrent requests wait for the same 'iotlab-status' command
+    with EXPERIMENTS_LOCK:
+        if time.time() - EXPERIMENTS["loaded_at"] < get_config().get("iot_experiment_ttl", 10):
+            return EXPERIMENTS["reservations"]
+        reservations = {}
+        process = subprocess.run("iotlab-status -er", shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        json_data = json.loads(process.stdout)["items"]
+        iot_site = get_config()["iot_site"]
+        for resa in json_data:
+            start_date = datetime.strptime(resa["start_date"], "%Y-%m-%dT%H:%M:%SZ")
+            start_date = start_date.replace(tzinfo=pytz.UTC)
+            info_res = {
+                "start_date": start_date.timestamp(),
+                "end_date": start_date.timestamp() + resa["submitted_duration"] * 60,
+                "owner": resa["user"]
+            }
+            for node_name in resa["nodes"]:
+                if iot_site in node_name:
+                    name_short = node_name.split(".")[0]
+                    if name_short not in reservations:
+                        reservations[name_short] = []
+                    reservations[name_short].append(info_res)
+        EXPERIMENTS["reservations"] = reservations
+        EXPERIMENTS["loaded_at"] = time.time()
+        return reservations
+
+
+# Get the reservations of the IoT-Lab plateform and the selections of the DB: { node_name: [ reservation ] }
 def experiment_to_reservation():
-    reservations = {}
-    # Get the reservations from the IoT-Lab plateform
-    process = subprocess.run("iotlab-status -er", shell=True,
-        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
-    json_data = json.loads(process.stdout)["items"]
-    iot_site = get_config()["iot_site"]
-    for resa in json_data:
-        for node_name in resa["nodes"]:
-            if iot_site in node_name:
-                name_short = node_name.split(".")[0]
-                if name_short not in reservations:
-                    reservations[name_short] = []
-                info_res = {}
-                start_date = datetime.strptime(resa["start_date"], "%Y-%m-%dT%H:%M:%SZ")
-                start_date = start_date.replace(tzinfo=pytz.UTC)
-                info_res["start_date"] = start_date.timestamp()
-                info_res["end_date"] = start_date.timestamp() + resa["submitted_duration"] * 60
-                info_res["owner"] = resa["user"]
-                reservations[name_short].append(info_res)
+    # Copy the lists of the cached reservations before adding the DB selections
+    reservations = { name: list(resa) for name, resa in platform_reservations().items() }
     # Get the reservations from the database
     db = open_session()
     db_selection = db.query(IotSelection).filter(IotSelection.node_ids != "").all()
@@ -64,35 +84,43 @@ def build_name(db_sel):
     return selection_name
 
 
+# Return the server list from memory (the list is rebuilt every 'inventory_ttl' seconds)
 def build_server_list():
-    # The file to build the server list without querying the grid5000 API
-    server_file = "node-iot.json"
-    # Get all nodes in the default queue of this site
+    return get_servers("node-iot.json", query_server_list)
+
+
+# Get the alive nodes of the site from the Iot-Lab plateform
+def query_server_list():
     servers = {}
-    if os.path.isfile(server_file):
-        with open(server_file, "r") as f:
-            servers = json.load(f)
-    else:
-        # List all nodes of the site
-        logging.info("Query the API to build the server list")
-        process = subprocess.run("iotlab-status --nodes --site %s" % get_config()["iot_site"],
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-            universal_newlines=True)
-        json_data = json.loads(process.stdout)["items"]
-        for node in json_data:
-            if node["state"] == "Alive" or node["state"] == "Busy":
-                node_name = node["network_address"].split(".")[0]
-                servers[node_name] = {
-                    "name": node_name,
-                    "archi": node["archi"],
-                    "site": node["site"],
-                    "coords (x,y,z)": "%s, %s, %s" % (node["x"], node["y"], node["z"])
-                }
-        with open(server_file, "w") as f:
-            f.write(json.dumps(servers, indent = 4))
+    process = subprocess.run("iotlab-status --nodes --site %s" % get_config()["iot_site"],
+        shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    json_data = json.loads(process.stdout)["items"]
+    for node in json_data:
+        if node["state"] == "Alive" or node["state"] == "Busy":
+            node_name = node["network_address"].split(".")[0]
+            servers[node_name] = {
+                "name": node_name,
+                "archi": node["archi"],
+                "site": node["site"],
+                "coords (x,y,z)": "%s, %s, %s" % (node["x"], node["y"], node["z"])
+            }
     return servers
 
 
+# Get the nodes assigned to the experiment, for example: 'm3-1@grenoble,m3-2@grenoble'
+def experiment_nodes(iot_user, iot_password, exp_id):
+    cmd = "iotlab-experiment -u %s -p %s get -i %s -n" % (iot_user, iot_password, exp_id)
+    process = subprocess.run(cmd, shell=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    node_data = json.loads(process.stdout)["items"]
+    assigned_nodes = []
+    for n in node_data:
+        name = n["network_address"]
+        assigned_nodes.append(name.split(".")[0] + "@" + name.split(".")[1])
+    return ",".join(assigned_nodes)
+
+
 def client_list(arg_dict):
     return json.dumps({ "error": "DHCP client list is not available from Iot-Lab agents" })
 
@@ -361,6 +389,8 @@ def node_mine(arg_dict):
         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
     json_data = json.loads(process.stdout)["items"]
     now = time.time()
+    # The jobs to send: [ (experiment, schedule, assigned_nodes) ]
+    my_jobs = []
     for resa in json_data:
         id_str = str(resa["id"])
         # Manage the jobs registrered in the DB
@@ -402,34 +432,32 @@ def node_mine(arg_dict):
         if my_sch is not None:
             # Get the list of the assigned nodes
             nodes = db.query(IotNodes).filter(IotNodes.job_id == resa["id"]).first()
-            if nodes is None:
-                cmd = "iotlab-experiment -u %s -p %s get -i %s -n" % (
-                    arg_dict["iot_user"], decrypt_password(arg_dict["iot_password"]), id_str)
-                process = subprocess.run(cmd, shell=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
-                node_data = json.loads(process.stdout)["items"]
-                assigned_nodes = []
-                for n in node_data:
-                    name = n["network_address"]
-                    assigned_nodes.append(name.split(".")[0] + "@" + name.split(".")[1])
-                nodes_str = ",".join(assigned_nodes)
-                nodes_db = IotNodes()
-                nodes_db.job_id = resa["id"]
-                nodes_db.assigned_nodes = nodes_str
-                db.add(nodes_db)
-            else:
-                nodes_str = nodes.assigned_nodes
-            # Send job information
-            result["nodes"][my_sch.node_name] = {
-                "node_name": my_sch.node_name,
-                "bin": my_sch.bin,
-                "start_date": my_sch.start_date,
-                "end_date": my_sch.end_date,
-                "state": resa["state"].lower(),
-                "assigned_nodes": nodes_str
-            }
-            result["nodes"][my_sch.node_name]["data_link"] = (
-                resa["state"] == "Terminated" or resa["state"] == "Stopped")
+            my_jobs.append((resa, my_sch, nodes))
+    # Get the assigned nodes of the new jobs with concurrent commands
+    new_ids = [ str(resa["id"]) for resa, my_sch, nodes in my_jobs if nodes is None ]
+    iot_password = decrypt_password(arg_dict["iot_password"])
+    new_nodes = dict(zip(new_ids, parallel_map(
+        lambda exp_id: experiment_nodes(arg_dict["iot_user"], iot_password, exp_id), new_ids)))
+    for resa, my_sch, nodes in my_jobs:
+        if nodes is None:
+            nodes_str = new_nodes[str(resa["id"])]
+            nodes_db = IotNodes()
+            nodes_db.job_id = resa["id"]
+            nodes_db.assigned_nodes = nodes_str
+            db.add(nodes_db)
+        else:
+            nodes_str = nodes.assigned_nodes
+        # Send job information
+        result["nodes"][my_sch.node_name] = {
+            "node_name": my_sch.node_name,
+            "bin": my_sch.bin,
+            "start_date": my_sch.start_date,
+            "end_date": my_sch.end_date,
+            "state": resa["state"].lower(),
+            "assigned_nodes": nodes_str
+        }
+        result["nodes"][my_sch.node_name]["data_link"] = (
+            resa["state"] == "Terminated" or resa["state"] == "Stopped")
     close_session(db)
     return json.dumps(result)
 
@@ -479,29 +507,9 @@ def node_reserve(arg_dict):
                     filtered_nodes.append(node["name"])
     # Check the availability of the filtered nodes
     logging.info("Filtered nodes: %s" % filtered_nodes)
-    selected_nodes = []
-    node_status = {}
-    for node_name in filtered_nodes:
-        ok_selected = True
-        # Move the start date back 15 minutes to give the time for destroying the previous reservation
-        back_date = start_date - 15 * 60
-        # Check the running experiments of the IoT-Lab plateform
-        for name, reservations in experiment_to_reservation().items():
-            if name == node_name:
-                for resa in reservations:
-                    # Only one reservation for a specific node per user
-                    if name == node_name and resa["owner"] == user:
-                        ok_selected = False
-                    # There is no reservation at the same date
-                    if (back_date > resa["start_date"] and back_date < resa["end_date"]) or \
-                        (back_date < resa["start_date"] and end_date > resa["start_date"]):
-                        ok_selected = False
-        if ok_selected:
-            # Add the node to the reservation
-            selected_nodes.append(node_name)
-            if len(selected_nodes) == nb_nodes:
-                # Exit when the required number of nodes is reached
-                break;
+    # Read the running experiments of the IoT-Lab plateform once for all the filtered nodes
+    selected_nodes = select_nodes(index_reservations(experiment_to_reservation()), filtered_nodes, nb_nodes,
+        start_date, end_date, user)
     logging.info("Selected nodes: %s" % selected_nodes)
     if len(selected_nodes) > 0:
         archi = servers[selected_nodes[0]]["archi"]
@@ -547,31 +555,10 @@ def node_reserve(arg_dict):
 
 
 def node_schedule(arg_dict):
-    result = { "nodes": {} }
-    # Get the list of servers
-    servers = build_server_list()
-    # Get the list of the reservations
-    for name, reservations in experiment_to_reservation().items():
-        if name not in result["nodes"]:
-            result["nodes"][name] = {}
-        for resa in reservations:
-            # Round the end_date up to the next hour
-            remains = resa["end_date"] % 3600
-            if remains == 0:
-                end_date_comp = resa["end_date"]
-            else:
-                end_date_comp = resa["end_date"] - remains + 3600
-            # Iterate over hours between start_date and end_date
-            hours_added = 0
-            while resa["start_date"] + hours_added * 3600 < end_date_comp:
-                new_date = resa["start_date"] + hours_added * 3600
-                result["nodes"][name][new_date] = {
-                    "owner": resa["owner"],
-                    "start_hour": resa["start_date"],
-                    "end_hour": resa["end_date"]
-                }
-                hours_added += 1
-    return json.dumps(result)
+    reservations = []
+    for node_name, node_res in experiment_to_reservation().items():
+        reservations += [ (node_name, r["start_date"], r["end_date"], r["owner"]) for r in node_res ]
+    return schedule_response(sorted(reservations, key = lambda r: (r[0], r[1])), arg_dict)
 
 
 def node_state(arg_dict):
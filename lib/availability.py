@@ -0,0 +1,49 @@
+from bisect import bisect_left
+
+# Delay in seconds between two reservations of the same node to give the time for destroying the previous one
+RELEASE_DELAY = 15 * 60
+
+
+# Index the reservations of every node by start date
+# reservations: { node_name: [ { "start_date": ts, "end_date": ts, "owner": "email@is.fr" } ] }
+# Return { node_name: { "starts": [ sorted start dates ], "max_ends": [ end max of the first reservations ], "owners": set() } }
+def index_reservations(reservations):
+    index = {}
+    for node_name, node_res in reservations.items():
+        ordered = sorted(node_res, key = lambda r: r["start_date"])
+        max_ends = []
+        max_end = None
+        for resa in ordered:
+            if max_end is None or resa["end_date"] > max_end:
+                max_end = resa["end_date"]
+            max_ends.append(max_end)
+        index[node_name] = {
+            "starts": [ resa["start_date"] for resa in ordered ],
+            "max_ends": max_ends,
+            "owners": set([ resa["owner"] for resa in ordered ])
+        }
+    return index
+
+
+# Check the node has no reservation of the user and no reservation overlapping [start_date - RELEASE_DELAY, end_date]
+def is_available(index, node_name, start_date, end_date, user):
+    node_index = index.get(node_name)
+    if node_index is None:
+        return True
+    # Only one reservation for a specific node per user
+    if user in node_index["owners"]:
+        return False
+    # The reservations starting before the end date must end before the start date
+    nb_before = bisect_left(node_index["starts"], end_date)
+    return nb_before == 0 or node_index["max_ends"][nb_before - 1] <= start_date - RELEASE_DELAY
+
+
+# Return the first nb_nodes available nodes of the candidate list
+def select_nodes(index, candidates, nb_nodes, start_date, end_date, user):
+    selected_nodes = []
+    for node_name in candidates:
+        if is_available(index, node_name, start_date, end_date, user):
+            selected_nodes.append(node_name)
+            if len(selected_nodes) == nb_nodes:
+                break
+    return selected_nodes
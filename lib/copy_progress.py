@@ -0,0 +1,121 @@
+from lib.config_loader import get_config
+from paramiko.ssh_exception import SSHException
+import json, logging, os, socket, threading, time
+
+# Close the progress channels that do not receive any value during this number of seconds
+CHANNEL_TIMEOUT = 60
+# Write the progress file at most once per this number of seconds
+PUBLISH_DELAY = 1
+# The progress of the environment copies read by the executor from the channels:
+# { node_name: { "bytes": copied bytes, "total": bytes, "percent": int, "eta": seconds, "done": bool } }
+PROGRESS = {}
+PROGRESS_LOCK = threading.Lock()
+PUBLISHED = { "date": 0 }
+# The progress values read from the progress file by the API: { "values": {}, "mtime": 0 }
+LOADED = { "values": {}, "mtime": 0 }
+
+
+def progress_path():
+    # The file shared by the executor and the API processes (tmpfs)
+    return get_config().get("progress_file", "/dev/shm/piseduce-progress.json")
+
+
+# Write the progress values to the progress file (the caller holds PROGRESS_LOCK)
+def publish(force = False):
+    now = time.time()
+    if not force and now - PUBLISHED["date"] < PUBLISH_DELAY:
+        return
+    values = { node_name: { k: v for k, v in p.items() if k in [ "bytes", "total", "percent", "eta" ] }
+        for node_name, p in PROGRESS.items() }
+    path = progress_path()
+    try:
+        with open("%s.tmp" % path, "w") as progress_file:
+            progress_file.write(json.dumps(values))
+        os.replace("%s.tmp" % path, path)
+        PUBLISHED["date"] = now
+    except OSError:
+        logging.exception("Can not write the progress file '%s'" % path)
+
+
+def update_progress(node_progress, copied):
+    now = time.time()
+    if node_progress["first_at"] is None:
+        node_progress["first_at"] = now
+        node_progress["first_bytes"] = copied
+    node_progress["bytes"] = copied
+    node_progress["percent"] = min(100, copied * 100 // max(1, node_progress["total"]))
+    # Estimate the remaining time from the rate measured since the first value
+    elapsed = now - node_progress["first_at"]
+    rate = (copied - node_progress["first_bytes"]) / elapsed if elapsed > 0 else 0
+    if rate > 0:
+        node_progress["eta"] = int(max(0, node_progress["total"] - copied) / rate)
+
+
+# Read the values written by the command on the channel until the end of the copy
+def read_channel(node_name, ssh, command):
+    try:
+        (stdin, stdout, stderr) = ssh.exec_command(command)
+        stdout.channel.settimeout(CHANNEL_TIMEOUT)
+        for line in stdout:
+            line = line.strip()
+            with PROGRESS_LOCK:
+                node_progress = PROGRESS.get(node_name)
+                if node_progress is None:
+                    return
+                if line == "done":
+                    node_progress["done"] = True
+                    node_progress["percent"] = 100
+                    node_progress["eta"] = 0
+                    publish(True)
+                    return
+                if line.isdigit():
+                    update_progress(node_progress, int(line))
+                    publish()
+    except (SSHException, socket.error) as e:
+        logging.warning("[%s] the progress channel is closed" % node_name)
+    # The copy is not completed, the channel will be opened again
+    with PROGRESS_LOCK:
+        PROGRESS.pop(node_name, None)
+        publish(True)
+
+
+# Open a channel to the node reading the progress of the copy
+# command: write the number of copied bytes on every line, then 'done' at the end of the copy
+# total: the number of bytes to copy
+def watch_copy(node_name, ssh, command, total):
+    with PROGRESS_LOCK:
+        if node_name in PROGRESS:
+            return
+        PROGRESS[node_name] = { "bytes": 0, "total": total, "percent": 0, "eta": None, "done": False,
+            "first_at": None, "first_bytes": 0 }
+        publish(True)
+    threading.Thread(target = read_channel, args = (node_name, ssh, command), daemon = True).start()
+
+
+# Return the progress of the copy or None if no channel is opened
+def copy_progress(node_name):
+    with PROGRESS_LOCK:
+        if node_name in PROGRESS:
+            return dict(PROGRESS[node_name])
+    return None
+
+
+def forget_copy(node_name):
+    with PROGRESS_LOCK:
+        if PROGRESS.pop(node_name, None) is not None:
+            publish(True)
+
+
+# Return the progress values published by the executor (reload the file when it is modified)
+def load_progress():
+    path = progress_path()
+    try:
+        mtime = os.path.getmtime(path)
+        if mtime != LOADED["mtime"]:
+            with open(path, "r") as progress_file:
+                LOADED["values"] = json.load(progress_file)
+            LOADED["mtime"] = mtime
+    except (OSError, ValueError):
+        LOADED["values"] = {}
+        LOADED["mtime"] = 0
+    return LOADED["values"]
@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+from lib.config_loader import get_config
+import os, threading
+
+# The threads calling the external APIs (Grid'5000 API, Iot-Lab CLI) for the request handlers
+FANOUT = { "pid": None, "executor": None }
+FANOUT_LOCK = threading.Lock()
+
+
+def fanout_executor():
+    with FANOUT_LOCK:
+        # Create the threads in the process that handles the requests (the API workers are forked)
+        if FANOUT["pid"] != os.getpid():
+            FANOUT["executor"] = ThreadPoolExecutor(max_workers = get_config().get("api_fanout_workers", 16))
+            FANOUT["pid"] = os.getpid()
+        return FANOUT["executor"]
+
+
+# Call the function with every element of the list at the same time, return the results in the order of the list
+# The functions must not use the DB session of the caller
+def parallel_map(fct, items):
+    items = list(items)
+    if len(items) < 2:
+        return [ fct(i) for i in items ]
+    return list(fanout_executor().map(fct, items))
+
+
+# Execute the functions without parameters at the same time, return their results
+def parallel_calls(*fcts):
+    return parallel_map(lambda fct: fct(), fcts)
@@ -0,0 +1,215 @@
+from lib.config_loader import get_config
+import hashlib, json, logging, os, struct, subprocess, sys, tarfile
+
+# Size in bytes of the chunks of the images (also the block size of the dd commands writing them)
+CHUNK_SIZE = 4 * 1024 * 1024
+# Commands compressing the chunks on the pimaster and decompressing them on the nodes
+COMPRESSORS = {
+    "zstd": ("zstd -q -3 -c", "zstd -q -d -c"),
+    "lz4": ("lz4 -q -c", "lz4 -q -d -c"),
+    "gzip": ("gzip -1 -c", "gzip -q -d -c")
+}
+
+
+def store_dir():
+    return os.path.join(get_config()["env_path"], "chunks")
+
+
+# The manifest of the image stored from the archive 'img_name' of the environment
+def manifest_path(img_name):
+    return os.path.join(get_config()["env_path"], "%s.manifest" % img_name)
+
+
+# The list of the data chunks of the image read by the pimaster to send the image
+def chunk_list_path(img_name):
+    return os.path.join(get_config()["env_path"], "%s.chunks" % img_name)
+
+
+# The path of the chunk relative to the store directory
+def chunk_name(digest, compressor):
+    return "%s/%s.%s" % (digest[:2], digest, compressor)
+
+
+# Return the manifest of the stored image or None if the image is not stored
+# The manifests built from a previous version of the archive are ignored (the archive is sent to the nodes)
+def load_manifest(img_name):
+    path = manifest_path(img_name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    archive_path = os.path.join(get_config()["env_path"], img_name)
+    if not os.path.isfile(archive_path) or manifest.get("archive_mtime") != os.path.getmtime(archive_path):
+        logging.warning("The manifest of '%s' does not match the archive" % img_name)
+        return None
+    return manifest
+
+
+# Delete the manifest of the image before replacing its archive
+def remove_manifest(img_name):
+    for path in [ manifest_path(img_name), chunk_list_path(img_name) ]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def write_file(path, data, mode = "wb"):
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, mode) as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+
+# Return the partitions of the MBR partition table: [ [ type, first_sector, sector_nb ] ]
+def mbr_partitions(mbr):
+    partitions = []
+    if len(mbr) < 512 or mbr[510:512] != b"\x55\xaa":
+        return partitions
+    for offset in range(446, 510, 16):
+        part_type = mbr[offset + 4]
+        first_sector, sector_nb = struct.unpack("<II", mbr[offset + 8:offset + 16])
+        if part_type != 0:
+            partitions.append([ part_type, first_sector, sector_nb ])
+    return partitions
+
+
+# Split the image of the archive in chunks stored by their SHA-256 (the identical chunks are stored once)
+# The chunks filled with zeros are not stored. The manifest is written after the chunks:
+# { "img_size": bytes, "chunk_size": bytes, "compressor": "zstd", "chunks": [ sha256 or None for zero chunks ],
+#   "partitions": [ partitions of the image, see mbr_partitions() ], "archive_mtime": mtime of the archive }
+def store_image(archive_path, compressor = None):
+    if compressor is None:
+        compressor = get_config().get("image_compressor", "zstd")
+    chunks = []
+    partitions = []
+    img_size = 0
+    zero_chunk = bytes(CHUNK_SIZE)
+    # Read before the archive, the manifest is ignored if the archive is replaced during the store
+    archive_mtime = os.path.getmtime(archive_path)
+    logging.info("Store the image of '%s' in '%s'" % (archive_path, store_dir()))
+    with tarfile.open(archive_path, "r|gz") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            img_file = archive.extractfile(member)
+            data = img_file.read(CHUNK_SIZE)
+            partitions = mbr_partitions(data[:512])
+            while len(data) > 0:
+                img_size += len(data)
+                if data == zero_chunk[:len(data)]:
+                    chunks.append(None)
+                else:
+                    digest = hashlib.sha256(data).hexdigest()
+                    path = os.path.join(store_dir(), chunk_name(digest, compressor))
+                    if not os.path.isfile(path):
+                        os.makedirs(os.path.dirname(path), exist_ok = True)
+                        process = subprocess.run(COMPRESSORS[compressor][0], shell=True, input=data,
+                            stdout=subprocess.PIPE, check=True)
+                        write_file(path, process.stdout)
+                    chunks.append(digest)
+                data = img_file.read(CHUNK_SIZE)
+            # The archive contains one image
+            break
+    manifest = { "img_size": img_size, "chunk_size": CHUNK_SIZE, "compressor": compressor, "chunks": chunks,
+        "partitions": partitions, "archive_mtime": archive_mtime }
+    img_name = os.path.basename(archive_path)
+    write_file(chunk_list_path(img_name), "".join([ "%s\n" % chunk_name(digest, compressor)
+        for digest in chunks if digest is not None ]), "w")
+    write_file(manifest_path(img_name), json.dumps(manifest), "w")
+    logging.info("'%s' stored: %d chunks, %d zero chunks" % (
+        archive_path, len(chunks), len([ c for c in chunks if c is None ])))
+    return manifest
+
+
+def store_image_safe(archive_path):
+    try:
+        store_image(archive_path)
+    except:
+        logging.exception("Can not store the image of '%s'" % archive_path)
+
+
+# Return the ranges of consecutive data chunks: [ (first_chunk_idx, chunk_nb) ]
+def data_runs(manifest):
+    runs = []
+    for idx, digest in enumerate(manifest["chunks"]):
+        if digest is not None:
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == idx:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((idx, 1))
+    return runs
+
+
+# Return the number of bytes of the data chunks (the uncompressed size of the stream sent to the nodes)
+def data_size(manifest):
+    chunk_size = manifest["chunk_size"]
+    return sum([ min(chunk_size, manifest["img_size"] - idx * chunk_size)
+        for idx, digest in enumerate(manifest["chunks"]) if digest is not None ])
+
+
+# Return the command sending the compressed chunks whose paths (relative to the store directory) are read on stdin
+def read_chunks_command():
+    return "cd %s && xargs -r cat" % store_dir()
+
+
+# Return the command sending the compressed data chunks from the pimaster
+def read_command(img_name):
+    return "%s < %s" % (read_chunks_command(), chunk_list_path(img_name))
+
+
+# Return the script writing the uncompressed data chunks read from stdin to their offsets on the device ($1)
+# The zero chunks are skipped
+def write_script(manifest):
+    lines = [ "dd of=$1 bs=%d seek=%d count=%d iflag=fullblock conv=notrunc 2> /dev/null" % (
+        manifest["chunk_size"], first, nb) for first, nb in data_runs(manifest) ]
+    return "\n".join(lines + [ "sync", "" ])
+
+
+# Return the script rewriting the data chunks that differ on the device ($1). The chunks are compared first, then
+# the differing chunks are read from the pimaster in one stream by read_cmd (see read_chunks_command())
+# The number of bytes compared or written is written to the progress file, the list of the differing chunks to
+# the list file
+def sync_script(manifest, read_cmd, progress_path, list_path):
+    chunk_size = manifest["chunk_size"]
+    lines = [
+        "DEV=$1",
+        "DONE=0",
+        "c() {",
+        "  if [ \"$(dd if=$DEV bs=%d skip=$1 count=1 2> /dev/null | head -c $2 | sha256sum | cut -c1-64)\" != \"$3\" ]; then" %
+            chunk_size,
+        "    echo \"$1 $2 $4\" >> %s" % list_path,
+        "  else",
+        "    DONE=$((DONE + $2))",
+        "    echo $DONE > %s" % progress_path,
+        "  fi",
+        "}",
+        "echo 0 > %s" % progress_path,
+        ": > %s" % list_path
+    ]
+    for idx, digest in enumerate(manifest["chunks"]):
+        if digest is not None:
+            lines.append("c %d %d %s %s" % (idx, min(chunk_size, manifest["img_size"] - idx * chunk_size), digest,
+                chunk_name(digest, manifest["compressor"])))
+    # Stop at the end of the stream (the progress does not reach the total size, the copy is incomplete)
+    lines += [
+        "if [ -s %s ]; then" % list_path,
+        "  cut -d ' ' -f 3 %s | %s | %s | while read IDX LEN CHUNK <&3; do" % (
+            list_path, read_cmd, COMPRESSORS[manifest["compressor"]][1]),
+        "    if dd of=$DEV bs=%d seek=$IDX count=1 iflag=fullblock conv=notrunc 2>&1 | grep -q '^0+0 records in'; then" %
+            chunk_size,
+        "      break",
+        "    fi",
+        "    DONE=$((DONE + LEN))",
+        "    echo $DONE > %s" % progress_path,
+        "  done 3< %s" % list_path,
+        "fi"
+    ]
+    return "\n".join(lines + [ "sync", "" ])
+
+
+# Store the images of existing environments: python3 -m lib.image_store config_agent.json img.tar.gz ...
+if __name__ == "__main__":
+    from lib.config_loader import load_config
+    load_config(sys.argv[1])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    for img_name in sys.argv[2:]:
+        store_image(os.path.join(get_config()["env_path"], img_name))
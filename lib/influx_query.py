@@ -0,0 +1,77 @@
+from influxdb import InfluxDBClient
+from lib.config_loader import get_config
+from urllib.parse import urlparse
+import logging, re, threading, time
+
+# Default period of the queries
+DEFAULT_PERIOD = "1h"
+# Maximum number of points per series returned by the queries (the values are averaged to stay below)
+MAX_SERIES_POINTS = 360
+# The available resolutions in seconds (the smallest one is the sampling period of the agents)
+RESOLUTIONS = [ 10, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 43200, 86400 ]
+# Number of seconds of the units of the InfluxDB durations
+DURATION_UNITS = { "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800 }
+# Lifetime in seconds of the query results
+CACHE_TTL = 10
+# The query results: { query: (expiration_date, points) }
+QUERY_CACHE = {}
+# The client reused by the queries of the process
+INFLUX = { "client": None }
+INFLUX_LOCK = threading.Lock()
+
+
+def influx_client():
+    with INFLUX_LOCK:
+        if INFLUX["client"] is None:
+            influx_url = urlparse(get_config().get("influx_url", "http://localhost:8086"))
+            INFLUX["client"] = InfluxDBClient(host = influx_url.hostname, port = influx_url.port or 8086,
+                database = get_config().get("influx_db", "monitoring"))
+        return INFLUX["client"]
+
+
+# Convert the InfluxDB duration (for example, '30m', '24h' or '7d') to seconds, return 0 for wrong durations
+def period_seconds(period):
+    match = re.fullmatch(r"(\d+)([smhdw])", str(period).strip())
+    if match is None:
+        return 0
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+# Choose the smallest resolution that keeps the number of points of every series below MAX_SERIES_POINTS
+def query_resolution(seconds):
+    for res in RESOLUTIONS:
+        if seconds / res <= MAX_SERIES_POINTS:
+            return res
+    return RESOLUTIONS[-1]
+
+
+# Return the average values of the field over the period: [ { "time", field, tag1, tag2, ... } ]
+# filters: { tag_name: tag_value } to select the series
+def query_mean(measurement, field, group_tags, period = None, filters = {}):
+    if period is None:
+        period = DEFAULT_PERIOD
+    seconds = period_seconds(period)
+    if seconds == 0:
+        return None
+    res = query_resolution(seconds)
+    influx_query = 'SELECT mean("%s") AS "%s" FROM "%s" WHERE time > now() - %ds' % (
+        field, field, measurement, seconds)
+    for tag in sorted(filters):
+        influx_query += " AND \"%s\" = '%s'" % (tag, str(filters[tag]).replace("\\", "\\\\").replace("'", "\\'"))
+    influx_query += " GROUP BY time(%ds), %s fill(none)" % (res, ", ".join([ '"%s"' % t for t in group_tags ]))
+    # Return the cached result of the identical queries
+    cached = QUERY_CACHE.get(influx_query)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    points = []
+    for (name, tags), series in influx_client().query(influx_query, epoch = "s").items():
+        for p in series:
+            p.update(tags)
+            points.append(p)
+    # Remove the expired results
+    now = time.time()
+    for key in [ k for k, v in list(QUERY_CACHE.items()) if v[0] <= now ]:
+        QUERY_CACHE.pop(key, None)
+    QUERY_CACHE[influx_query] = (now + CACHE_TTL, points)
+    logging.debug("%d points from '%s'" % (len(points), influx_query))
+    return points
@@ -0,0 +1,221 @@
+from collections import deque
+from datetime import datetime, timezone
+from glob import glob
+from lib.config_loader import get_config
+import atexit, gzip, logging, os, threading, time, urllib.error, urllib.parse, urllib.request
+
+# Maximum number of points in the memory buffer (the oldest points are dropped when the buffer is full)
+MAX_POINTS = 100000
+# Number of points sent in one request
+BATCH_SIZE = 5000
+# Default delay in seconds before sending the buffered points (see 'influx_flush')
+FLUSH_INTERVAL = 5
+# Timeout in seconds of the requests to the InfluxDB
+HTTP_TIMEOUT = 10
+# Maximum size in bytes of the file storing the points when the InfluxDB is not available
+MAX_SPILL_SIZE = 100 * 1024 * 1024
+# The state of the writer of this process (see start_writer())
+WRITER = { "pid": None, "name": None, "lines": None, "lock": None, "event": None, "spill": None }
+START_LOCK = threading.Lock()
+
+
+def escape_key(value):
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def format_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "%di" % value
+    if isinstance(value, float):
+        return repr(value)
+    return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+# Convert the point { "measurement", "tags", "fields", "time" } to the InfluxDB line protocol (second precision)
+# The time is a number of seconds since epoch or a UTC date in the ISO format
+def to_line(point):
+    line = point["measurement"].replace(",", "\\,").replace(" ", "\\ ")
+    for key in sorted(point.get("tags", {})):
+        line += ",%s=%s" % (escape_key(key), escape_key(point["tags"][key]))
+    line += " " + ",".join([ "%s=%s" % (escape_key(key), format_field(value))
+        for key, value in point["fields"].items() ])
+    timestamp = point.get("time")
+    if timestamp is None:
+        timestamp = time.time()
+    elif isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp).replace(tzinfo = timezone.utc).timestamp()
+    return "%s %d" % (line, int(timestamp))
+
+
+# Write the points rejected by the InfluxDB to the rejected file (they are not sent again)
+def reject_lines(lines, error):
+    rejected_file = WRITER["spill"].replace(".spill", ".rejected")
+    logging.error("The InfluxDB rejects %d points (%s), store them in '%s'" % (len(lines), error, rejected_file))
+    if os.path.isfile(rejected_file) and os.path.getsize(rejected_file) > MAX_SPILL_SIZE:
+        logging.error("The rejected file '%s' is full: %d points are lost" % (rejected_file, len(lines)))
+        return
+    with open(rejected_file, "a") as rejected:
+        rejected.write("\n".join(lines) + "\n")
+
+
+# Send the points, return False or raise an exception if the points must be sent again
+# The points rejected by the InfluxDB (HTTP 4xx, for example a wrong line protocol) are not sent again
+def send_lines(lines):
+    influx_url = get_config().get("influx_url", "http://localhost:8086")
+    influx_db = get_config().get("influx_db", "monitoring")
+    request = urllib.request.Request("%s/write?db=%s&precision=s" % (influx_url, influx_db),
+        data = gzip.compress("\n".join(lines).encode("utf-8")), method = "POST",
+        headers = { "Content-Encoding": "gzip", "Content-Type": "text/plain; charset=utf-8" })
+    try:
+        with urllib.request.urlopen(request, timeout = HTTP_TIMEOUT) as response:
+            return response.status == 204
+    except urllib.error.HTTPError as e:
+        if 400 <= e.code < 500:
+            reject_lines(lines, "HTTP %d: %s" % (e.code, e.read(200).decode("utf-8", "replace").strip()))
+            return True
+        raise
+
+
+# Create the database of the points ('influx_db') on the InfluxDB receiving them ('influx_url')
+# The database is not created twice by the InfluxDB
+def create_database():
+    influx_url = get_config().get("influx_url", "http://localhost:8086")
+    influx_db = get_config().get("influx_db", "monitoring")
+    query = urllib.parse.urlencode({ "q": 'CREATE DATABASE "%s"' % influx_db.replace('"', '\\"') })
+    request = urllib.request.Request("%s/query" % influx_url, data = query.encode("utf-8"), method = "POST",
+        headers = { "Content-Type": "application/x-www-form-urlencoded" })
+    try:
+        with urllib.request.urlopen(request, timeout = HTTP_TIMEOUT) as response:
+            return response.status == 200
+    except Exception as e:
+        logging.warning("Can not create the '%s' database on '%s' (%s)" % (influx_db, influx_url, e))
+    return False
+
+
+# Write the points to the spill file to send them when the InfluxDB is available again
+def spill_lines(lines):
+    spill_file = WRITER["spill"]
+    if os.path.isfile(spill_file) and os.path.getsize(spill_file) > MAX_SPILL_SIZE:
+        logging.error("The spill file '%s' is full: %d points are lost" % (spill_file, len(lines)))
+        return
+    with open(spill_file, "a") as spill:
+        spill.write("\n".join(lines) + "\n")
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Append the points of the spill files of the stopped processes (e.g., restarted gunicorn workers) to the spill
+# file of this process
+def adopt_spills():
+    prefix = "influx-%s" % WRITER["name"]
+    adopt_file = WRITER["spill"] + ".adopt"
+    for path in glob("%s-*.spill*" % prefix) + glob("%s.spill*" % prefix):
+        pid = path[len(prefix):].lstrip("-").split(".")[0]
+        if pid.isdigit() and is_running(int(pid)):
+            continue
+        try:
+            # Another process can adopt the same file
+            os.replace(path, adopt_file)
+        except FileNotFoundError:
+            continue
+        logging.info("Adopt the points of the spill file '%s'" % path)
+        with open(adopt_file, "r") as adopt, open(WRITER["spill"], "a") as spill:
+            spill.write(adopt.read())
+        os.remove(adopt_file)
+
+
+# Send the points of the spill file
+def replay_spill():
+    adopt_spills()
+    spill_file = WRITER["spill"]
+    replay_file = spill_file + ".replay"
+    if os.path.isfile(spill_file):
+        if os.path.isfile(replay_file):
+            # A previous replay failed: append the new points to the points to replay
+            with open(spill_file, "r") as spill, open(replay_file, "a") as replay:
+                replay.write(spill.read())
+            os.remove(spill_file)
+        else:
+            os.replace(spill_file, replay_file)
+    if not os.path.isfile(replay_file):
+        return True
+    with open(replay_file, "r") as replay:
+        lines = [ line.strip() for line in replay if len(line.strip()) > 0 ]
+    logging.info("Replay %d points from the spill file" % len(lines))
+    for idx in range(0, len(lines), BATCH_SIZE):
+        if not send_lines(lines[idx:idx + BATCH_SIZE]):
+            return False
+    os.remove(replay_file)
+    return True
+
+
+def flush_lines():
+    lines = WRITER["lines"]
+    while len(lines) > 0:
+        batch = []
+        with WRITER["lock"]:
+            while len(lines) > 0 and len(batch) < BATCH_SIZE:
+                batch.append(lines.popleft())
+        try:
+            if not send_lines(batch):
+                raise IOError("Unexpected status from the InfluxDB")
+        except Exception as e:
+            logging.warning("Can not write %d points to the InfluxDB (%s), store them in '%s'" % (
+                len(batch), e, WRITER["spill"]))
+            spill_lines(batch)
+            # Store the remaining points until the next flush
+            with WRITER["lock"]:
+                batch = list(lines)
+                lines.clear()
+            if len(batch) > 0:
+                spill_lines(batch)
+            return False
+    return True
+
+
+def flush_loop():
+    while True:
+        WRITER["event"].wait(get_config().get("influx_flush", FLUSH_INTERVAL))
+        WRITER["event"].clear()
+        try:
+            if flush_lines():
+                replay_spill()
+        except Exception:
+            logging.exception("InfluxDB writer error")
+
+
+# Start the writer in the current process (the thread is started again after a fork)
+def start_writer(name):
+    with START_LOCK:
+        if WRITER["pid"] == os.getpid():
+            return
+        WRITER["lines"] = deque(maxlen = MAX_POINTS)
+        WRITER["lock"] = threading.Lock()
+        WRITER["event"] = threading.Event()
+        # One spill file per process (the API workers use the same writer name)
+        WRITER["name"] = name
+        WRITER["spill"] = "influx-%s-%d.spill" % (name, os.getpid())
+        threading.Thread(target = flush_loop, daemon = True).start()
+        atexit.register(flush_lines)
+        WRITER["pid"] = os.getpid()
+
+
+# Buffer the points, they are sent every 'influx_flush' seconds or when BATCH_SIZE points are buffered
+def write_points(points, name = "agent"):
+    start_writer(name)
+    lines = [ to_line(p) for p in points ]
+    with WRITER["lock"]:
+        WRITER["lines"].extend(lines)
+        full = len(WRITER["lines"]) >= BATCH_SIZE
+    if full:
+        WRITER["event"].set()
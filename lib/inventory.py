@@ -0,0 +1,59 @@
+from lib.config_loader import get_config
+import json, logging, os, threading, time
+
+# The server lists of the node drivers: { file_path: { "servers": {}, "loaded_at": timestamp, "refreshing": bool } }
+INVENTORY = {}
+INVENTORY_LOCK = threading.Lock()
+
+
+def inventory_ttl():
+    # Rebuild the server lists older than this number of seconds
+    return get_config().get("inventory_ttl", 3600)
+
+
+# Write the server list to a temporary file and replace the previous file
+def save_servers(file_path, servers):
+    tmp_path = "%s.tmp" % file_path
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(servers, indent = 4))
+    os.replace(tmp_path, file_path)
+
+
+def refresh_servers(file_path, build_fct):
+    try:
+        logging.info("Query the API to build the server list '%s'" % file_path)
+        servers = build_fct()
+        save_servers(file_path, servers)
+        with INVENTORY_LOCK:
+            INVENTORY[file_path]["servers"] = servers
+            INVENTORY[file_path]["loaded_at"] = time.time()
+    except:
+        logging.exception("Can not build the server list '%s'" % file_path)
+    finally:
+        with INVENTORY_LOCK:
+            INVENTORY[file_path]["refreshing"] = False
+
+
+# Return the server list from memory, the outdated lists are rebuilt by a background thread
+# build_fct: query the API and return the server list { server_name: { properties } }
+def get_servers(file_path, build_fct):
+    with INVENTORY_LOCK:
+        if file_path not in INVENTORY:
+            INVENTORY[file_path] = { "servers": None, "loaded_at": 0, "refreshing": False }
+            if os.path.isfile(file_path):
+                with open(file_path, "r") as f:
+                    INVENTORY[file_path]["servers"] = json.load(f)
+                INVENTORY[file_path]["loaded_at"] = os.path.getmtime(file_path)
+        inventory = INVENTORY[file_path]
+        outdated = time.time() - inventory["loaded_at"] > inventory_ttl()
+        start_refresh = outdated and not inventory["refreshing"] and inventory["servers"] is not None
+        if start_refresh:
+            inventory["refreshing"] = True
+    if start_refresh:
+        threading.Thread(target = refresh_servers, args = (file_path, build_fct), daemon = True).start()
+    if inventory["servers"] is None:
+        # No server list yet: build it before answering
+        refresh_servers(file_path, build_fct)
+        if inventory["servers"] is None:
+            return {}
+    return inventory["servers"]
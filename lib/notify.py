@@ -0,0 +1,43 @@
+from lib.config_loader import get_config
+import logging, select, socket
+
+# Notifications are sent to the local executor only
+NOTIFY_HOST = "127.0.0.1"
+
+
+# Wake up agent_exec.py after a DB modification (new reservations, new actions, ...)
+def notify_executor():
+    if "notify_port" not in get_config():
+        return False
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(b"wakeup", (NOTIFY_HOST, get_config()["notify_port"]))
+        sock.close()
+        return True
+    except socket.error:
+        logging.exception("Can not notify the executor")
+    return False
+
+
+# Open the socket receiving the notifications (used by agent_exec.py)
+def open_notify_socket():
+    if "notify_port" not in get_config():
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((NOTIFY_HOST, get_config()["notify_port"]))
+    sock.setblocking(False)
+    return sock
+
+
+# Wait for a notification or the timeout (in seconds). Return True if a notification is received
+def wait_notification(sock, timeout):
+    readable, _, _ = select.select([ sock ], [], [], timeout)
+    if len(readable) == 0:
+        return False
+    # Read all pending notifications: one loop iteration handles them all
+    try:
+        while True:
+            sock.recv(64)
+    except socket.error:
+        pass
+    return True
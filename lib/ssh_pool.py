@@ -0,0 +1,88 @@
+from lib.config_loader import get_config
+import logging, paramiko, socket, threading, time
+
+# Interval in seconds between two keepalive packets on the idle connections
+SSH_KEEPALIVE = 15
+# Check the connection with a new channel if it is not used for more than SSH_CHECK_IDLE seconds
+SSH_CHECK_IDLE = 10
+# The SSH connections indexed by (node_ip, user): { "client": SSHClient, "last_used": timestamp }
+SSH_POOL = {}
+POOL_LOCK = threading.Lock()
+
+
+# The SSH client of the pool: the commands fail (socket.timeout) if they do not send data or do not exit during
+# 'ssh_command_timeout' seconds
+class PooledClient(paramiko.SSHClient):
+    def exec_command(self, command, bufsize = -1, timeout = None, **kwargs):
+        if timeout is None:
+            timeout = get_config().get("ssh_command_timeout", 60)
+        (stdin, stdout, stderr) = super().exec_command(command, bufsize, timeout, **kwargs)
+        # The recv_exit_status() of paramiko ignores the timeout of the channel
+        channel = stdout.channel
+        def recv_exit_status():
+            if not channel.status_event.wait(timeout):
+                raise socket.timeout("no exit status after %d seconds" % timeout)
+            return channel.exit_status
+        channel.recv_exit_status = recv_exit_status
+        return (stdin, stdout, stderr)
+
+
+def idle_timeout():
+    # Close the connections that are not used for more than 'ssh_idle_timeout' seconds
+    return get_config().get("ssh_idle_timeout", 120)
+
+
+def is_alive(pool_entry, timeout):
+    transport = pool_entry["client"].get_transport()
+    if transport is None or not transport.is_active() or not transport.is_authenticated():
+        return False
+    if time.time() - pool_entry["last_used"] > SSH_CHECK_IDLE:
+        # Open a channel to check the remote host still answers (cheaper than a new handshake)
+        try:
+            channel = transport.open_session(timeout = timeout)
+            channel.close()
+        except Exception:
+            return False
+    return True
+
+
+def evict_idle():
+    now = time.time()
+    with POOL_LOCK:
+        idle_keys = [ key for key in SSH_POOL if now - SSH_POOL[key]["last_used"] > idle_timeout() ]
+        idle_entries = [ SSH_POOL.pop(key) for key in idle_keys ]
+    for entry in idle_entries:
+        entry["client"].close()
+
+
+# Return a SSH connection to the node from the pool (the connection must not be closed by the caller)
+def ssh_connect(node_ip, user, timeout):
+    evict_idle()
+    key = (node_ip, user)
+    with POOL_LOCK:
+        entry = SSH_POOL.get(key)
+    if entry is not None:
+        if is_alive(entry, timeout):
+            entry["last_used"] = time.time()
+            return entry["client"]
+        logging.info("[%s] close the broken SSH connection (user: %s)" % (node_ip, user))
+        ssh_invalidate(node_ip, user)
+    ssh = PooledClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(node_ip, username = user, timeout = timeout)
+    ssh.get_transport().set_keepalive(SSH_KEEPALIVE)
+    with POOL_LOCK:
+        old_entry = SSH_POOL.get(key)
+        SSH_POOL[key] = { "client": ssh, "last_used": time.time() }
+    if old_entry is not None:
+        old_entry["client"].close()
+    return ssh
+
+
+# Close the connections to the node, e.g., the node reboots or switches to another filesystem
+def ssh_invalidate(node_ip, user = None):
+    with POOL_LOCK:
+        keys = [ key for key in SSH_POOL if key[0] == node_ip and (user is None or key[1] == user) ]
+        entries = [ SSH_POOL.pop(key) for key in keys ]
+    for entry in entries:
+        entry["client"].close()
@@ -1,36 +1,136 @@
 from database.connector import open_session, close_session
 from database.tables import RaspSwitch
-import subprocess, traceback
+from lib.config_loader import get_config
+from pysnmp.hlapi.asyncio import bulkCmd, setCmd, CommunityData, ContextData, ObjectIdentity, ObjectType
+from pysnmp.hlapi.asyncio import SnmpEngine, UdpTransportTarget
+from pysnmp.proto.rfc1902 import Integer
+from pysnmp.proto.rfc1905 import EndOfMibView
+import asyncio, os, threading, time, traceback
 
+# Timeout in seconds and number of retries of the SNMP requests
+SNMP_TIMEOUT = 3
+SNMP_RETRIES = 1
+# Maximum number of variables in one SET request (the cheap switches drop the large requests)
+SNMP_MAX_VARBINDS = 24
+# Number of variables read by every GETBULK request
+SNMP_BULK_SIZE = 25
+# The date of the next request allowed for every switch: { switch_ip: timestamp }
+NEXT_REQUEST = {}
+RATE_LOCK = threading.Lock()
+# The event loop and the SNMP engine of the synchronous requests (see run_snmp())
+SNMP_LOOP = { "pid": None, "loop": None, "engine": None }
+SNMP_LOCK = threading.Lock()
 
-def switch_cons(ip, community, oid):
+
+def min_interval():
+    # Minimum delay in seconds between two requests sent to the same switch
+    return get_config().get("snmp_min_interval", 0.2)
+
+
+# Wait for the next request allowed by the switch (shared by the threads and the coroutines of the process)
+async def rate_limit(switch_ip):
+    with RATE_LOCK:
+        now = time.time()
+        slot = max(now, NEXT_REQUEST.get(switch_ip, 0))
+        NEXT_REQUEST[switch_ip] = slot + min_interval()
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+def snmp_target(switch_ip):
+    return UdpTransportTarget((switch_ip, 161), timeout = SNMP_TIMEOUT, retries = SNMP_RETRIES)
+
+
+# Convert the OID written by snmpwalk ('iso.3.6.1...') to the numeric OID of the responses ('1.3.6.1...')
+def numeric_oid(oid):
+    oid = oid.strip().strip(".")
+    if oid.startswith("iso."):
+        oid = "1." + oid[4:]
+    return oid
+
+
+# Return the [ (oid, value) ] list of the variables in the subtree of the OID
+async def snmp_walk(engine, switch_ip, community, oid):
     result = []
+    oid = numeric_oid(oid)
+    next_oid = oid
+    while next_oid is not None:
+        await rate_limit(switch_ip)
+        error_ind, error_status, error_idx, var_table = await bulkCmd(engine, CommunityData(community),
+            snmp_target(switch_ip), ContextData(), 0, SNMP_BULK_SIZE, ObjectType(ObjectIdentity(next_oid)))
+        if error_ind or error_status:
+            raise RuntimeError("SNMP walk error from %s: %s" % (switch_ip, error_ind or error_status.prettyPrint()))
+        next_oid = None
+        for row in var_table:
+            # GETBULK responses are tables with one column per requested OID
+            if not isinstance(row, ObjectType):
+                row = row[0]
+            var_oid = str(row[0])
+            if not var_oid.startswith(oid + ".") or isinstance(row[1], EndOfMibView):
+                return result
+            result.append((var_oid, row[1]))
+            next_oid = var_oid
+    return result
+
+
+# Set the integer values of the OIDs: [ (oid, value) ]
+async def snmp_set(engine, switch_ip, community, values):
+    for idx in range(0, len(values), SNMP_MAX_VARBINDS):
+        var_binds = [ ObjectType(ObjectIdentity(numeric_oid(oid)), Integer(value))
+            for oid, value in values[idx:idx + SNMP_MAX_VARBINDS] ]
+        await rate_limit(switch_ip)
+        error_ind, error_status, error_idx, _ = await setCmd(engine, CommunityData(community),
+            snmp_target(switch_ip), ContextData(), *var_binds)
+        if error_ind or error_status:
+            raise RuntimeError("SNMP set error from %s: %s" % (switch_ip, error_ind or error_status.prettyPrint()))
+
+
+# Read the consumption of the ports (in Watts)
+async def snmp_cons(engine, switch_ip, community, oid):
+    result = []
+    for var_oid, value in await snmp_walk(engine, switch_ip, community, oid[:oid.rindex(".")]):
+        if value.tagSet == Integer.tagSet:
+            # The consumption is in mW
+            result.append(int(value) / 1000)
+        else:
+            result.append(float(str(value).replace('"', '')))
+    return result
+
+
+def snmp_loop():
+    with SNMP_LOCK:
+        # Start the loop in the process that sends the requests (the API workers are forked)
+        if SNMP_LOOP["pid"] != os.getpid():
+            SNMP_LOOP["loop"] = asyncio.new_event_loop()
+            SNMP_LOOP["engine"] = None
+            threading.Thread(target = SNMP_LOOP["loop"].run_forever, daemon = True).start()
+            SNMP_LOOP["pid"] = os.getpid()
+        return SNMP_LOOP["loop"]
+
+
+# Execute a SNMP coroutine from synchronous code (API, executor)
+# The coroutines of all the threads run in the same loop and share the same engine
+def run_snmp(snmp_fct, *args):
+    async def run():
+        # The engine is bound to the loop that creates it
+        if SNMP_LOOP["engine"] is None:
+            SNMP_LOOP["engine"] = SnmpEngine()
+        return await snmp_fct(SNMP_LOOP["engine"], *args)
+    return asyncio.run_coroutine_threadsafe(run(), snmp_loop()).result()
+
+
+def switch_cons(ip, community, oid):
     try:
-        cmd = "snmpwalk -v2c -c %s %s %s" % (community, ip, oid[:oid.rindex(".")])
-        process = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-            universal_newlines=True, timeout=30)
-        power_state = process.stdout.split("\n")
-        power_state = [p.split(" = ") for p in power_state if len(p) > 0]
-        if process.returncode == 0 and len(power_state) > 0:
-            for p in power_state:
-                if "INTEGER" in p[1]:
-                    result.append(int(p[1].split()[-1]) / 1000)
-                else:
-                    result.append(float(p[1].split()[-1].replace('"', '')))
+        return run_snmp(snmp_cons, ip, community, oid)
     except:
         traceback.print_exc()
-    return result
+    return []
 
 
 def switch_test(ip, community, oid):
     try:
-        nb_port = 0
-        cmd = "snmpwalk -v2c -c %s %s %s" % (community, ip, oid[:oid.rindex(".")])
-        process = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-            universal_newlines=True, timeout=30)
-        power_state = process.stdout.split("\n")
-        power_state = [p.split(" = ")[0] for p in power_state if len(p) > 0]
-        if process.returncode == 0 and len(power_state) > 0:
+        power_state = [ var_oid for var_oid, value in run_snmp(snmp_walk, ip, community, oid[:oid.rindex(".")]) ]
+        if len(power_state) > 0:
             oid_first_port = power_state[0]
             offset = int(oid_first_port[oid_first_port.rindex("."):][1:]) - 1
             detected_oid = oid_first_port[:oid_first_port.rindex(".")]
@@ -60,20 +160,38 @@ def get_poe_status(switch_name):
     db = open_session()
     sw = db.query(RaspSwitch).filter(RaspSwitch.name == switch_name).first()
     oid = sw.poe_oid
-    cmd = "snmpwalk -v2c -c %s %s %s" % (sw.community, sw.ip, oid[:oid.rindex(".")])
+    switch_ip = sw.ip
+    community = sw.community
     close_session(db)
-    process = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
-    power_state = process.stdout.split("\n")
-    return [p[-1] for p in power_state if len(p) > 0]
+    power_state = run_snmp(snmp_walk, switch_ip, community, oid[:oid.rindex(".")])
+    return [ str(value)[-1] for var_oid, value in power_state ]
 
 
-def set_power_port(switch_name, port, value):
+# Set the PoE value of the ports of the switch with one SNMP request (1: on, 2: off)
+def set_power_ports(switch_name, ports, value):
+    if len(ports) == 0:
+        return True
     db = open_session()
     sw = db.query(RaspSwitch).filter(RaspSwitch.name == switch_name).first()
-    snmp_address = "%s.%d" % (sw.poe_oid, sw.oid_offset + int(port))
-    cmd = "snmpset -v2c -c %s %s %s i %s" % (sw.community, sw.ip, snmp_address, value)
+    values = [ ("%s.%d" % (sw.poe_oid, sw.oid_offset + int(port)), value) for port in ports ]
+    switch_ip = sw.ip
+    community = sw.community
     close_session(db)
-    subprocess.run(cmd.split(), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    run_snmp(snmp_set, switch_ip, community, values)
+    return True
+
+
+def set_power_port(switch_name, port, value):
+    return set_power_ports(switch_name, [ port ], value)
+
+
+def turn_on_ports(switch_name, ports):
+    set_power_ports(switch_name, ports, 1)
+    return True
+
+
+def turn_off_ports(switch_name, ports):
+    set_power_ports(switch_name, ports, 2)
     return True
 
 
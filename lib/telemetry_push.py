@@ -0,0 +1,33 @@
+from lib.config_loader import get_config
+import logging, os, time
+
+
+def push_dir():
+    # Directory (tmpfs) of the files touched by the API on every telemetry push, one file per node
+    return get_config().get("telemetry_dir", "/dev/shm/piseduce-telemetry")
+
+
+# Register the date of the last telemetry push of the node (shared by the API processes and the agents)
+def mark_push(node_name):
+    path = os.path.join(push_dir(), os.path.basename(node_name))
+    try:
+        os.makedirs(push_dir(), exist_ok = True)
+        with open(path, "a"):
+            os.utime(path, None)
+    except OSError:
+        logging.exception("[%s] can not register the telemetry push" % node_name)
+
+
+# Return the names of the nodes that pushed their telemetry during the last 'telemetry_fallback' seconds
+# The other nodes are read with SSH connections
+def pushing_nodes():
+    max_age = get_config().get("telemetry_fallback", 60)
+    now = time.time()
+    nodes = set()
+    try:
+        for entry in os.scandir(push_dir()):
+            if now - entry.stat().st_mtime < max_age:
+                nodes.add(entry.name)
+    except OSError:
+        pass
+    return nodes
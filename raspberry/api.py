@@ -1,9 +1,12 @@
-from api.tool import safe_string
-from database.connector import open_session, close_session
-from database.tables import Action, ActionProperty, RaspEnvironment, RaspNode, Schedule, RaspSwitch
+from api.tool import safe_string, schedule_response, schedule_window
+from database.connector import open_session, close_session, get_node_conf, NODE_CONF_PROPS
+from database.tables import Action, ActionProperty, NodeConf, RaspEnvironment, RaspNode, Schedule, RaspSwitch
 from importlib import import_module
-from influxdb import InfluxDBClient
+from lib.availability import index_reservations, select_nodes
 from lib.config_loader import get_config
+from lib.copy_progress import load_progress
+from lib.influx_query import query_mean
+from lib.notify import notify_executor
 from sqlalchemy import distinct, and_, or_
 from agent_exec import free_reserved_node, new_action, init_action_process, save_reboot_state
 import json, logging, os, time
@@ -55,26 +58,13 @@ def register_environment(arg_dict):
     # The deployment is completed, add a new action
     init_action_process(node_action, "reg_env")
     db.add(node_action)
-    # Delete old values
-    old_props = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == node.node_name
-        ).filter(ActionProperty.prop_name.in_(["img_path", "env_name" ])
-        ).all()
-    for p in old_props:
-        db.delete(p)
-    act_prop = ActionProperty()
-    act_prop.node_name = node.node_name
-    act_prop.prop_name = "img_path"
-    act_prop.prop_value = arg_dict["img_path"]
-    act_prop.owner = node.owner
-    db.add(act_prop)
-    act_prop = ActionProperty()
-    act_prop.node_name = node.node_name
-    act_prop.prop_name = "env_name"
-    act_prop.prop_value = arg_dict["env_name"]
-    act_prop.owner = node.owner
-    db.add(act_prop)
+    # Replace the old values
+    node_conf = get_node_conf(db, node.node_name, node.owner)
+    node_conf.img_path = arg_dict["img_path"]
+    node_conf.env_name = arg_dict["env_name"]
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     return json.dumps({ "success": "environment is registering" })
 
 def environment_list(arg_dict):
@@ -119,6 +109,8 @@ def node_bootfiles(arg_dict):
                 n.node_name, n.state))
             result[n.node_name] = "failure: %s is not ready" % n.node_name
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -199,27 +191,37 @@ def node_deploy(arg_dict):
                 existing = db.query(ActionProperty).filter(ActionProperty.node_name == n.node_name).all()
                 for to_del in existing:
                     db.delete(to_del)
+                node_conf = get_node_conf(db, n.node_name, user_email)
+                node_conf.owner = user_email
+                for prop in NODE_CONF_PROPS:
+                    setattr(node_conf, prop, None)
                 # Write the configuration to the database
                 for prop in node_prop[n.node_name]:
                     if len(node_prop[n.node_name][prop]) > 0:
-                        act_prop = ActionProperty()
-                        act_prop.node_name = n.node_name
-                        act_prop.prop_name = prop
-                        act_prop.owner = user_email
                         if "ssh_key" in prop or "os_password" == prop:
-                            act_prop.prop_value = node_prop[n.node_name][prop]
+                            prop_value = node_prop[n.node_name][prop]
                         else:
                             # Remove special characters from value
                             safe_value = safe_string(node_prop[n.node_name][prop])
                             # Remove spaces from value
-                            safe_value = safe_value.replace(" ", "_")
-                            act_prop.prop_value = safe_value
-                        db.add(act_prop)
+                            prop_value = safe_value.replace(" ", "_")
+                        if prop in NODE_CONF_PROPS:
+                            setattr(node_conf, prop, prop_value)
+                        else:
+                            # Store the other properties in the ActionProperty table
+                            act_prop = ActionProperty()
+                            act_prop.node_name = n.node_name
+                            act_prop.prop_name = prop
+                            act_prop.prop_value = prop_value
+                            act_prop.owner = user_email
+                            db.add(act_prop)
                 n.state = "ready"
                 n.bin = node_bin
                 logging.info("[%s] change state to 'ready'" % n.node_name)
                 result[n.node_name]["state"] = n.state
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     return json.dumps(result)
 
 
@@ -254,6 +256,8 @@ def node_deployagain(arg_dict):
         else:
             result[n.node_name] = "failure: %s is not ready" % n.node_name
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -295,6 +299,8 @@ def node_destroy(arg_dict):
             db.add(node_action)
             result[n.node_name] = "success"
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -329,6 +335,8 @@ def node_extend(arg_dict):
         n.end_date = new_end_date
         result[n.node_name] = "success"
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -366,6 +374,8 @@ def node_hardreboot(arg_dict):
                 n.node_name, n.state))
             result[n.node_name] = "failure: %s is not ready" % n.node_name
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     # Build the result
     for n in wanted:
         if n not in result:
@@ -419,24 +429,23 @@ def node_mine(arg_dict):
         result["nodes"][n.name]["port_number"] = n.port_number
         result["nodes"][n.name]["model"] = n.model
         result["nodes"][n.name]["serial"] = n.serial
-    envs = db.query(ActionProperty
-        ).filter(ActionProperty.node_name.in_(result["nodes"].keys())
-        ).filter(ActionProperty.prop_name.in_(["environment", "os_password"])
-        ).all()
+    confs = db.query(NodeConf).filter(NodeConf.node_name.in_(result["nodes"].keys())).all()
     env_web = {}
-    for e in envs:
-        if e.prop_name == "environment":
+    for c in confs:
+        if c.environment is not None:
             # Check if the environment provides a web interface
-            if e.prop_value not in env_web:
-                has_web = db.query(RaspEnvironment).filter(RaspEnvironment.name == e.prop_value
+            if c.environment not in env_web:
+                has_web = db.query(RaspEnvironment).filter(RaspEnvironment.name == c.environment
                     ).first().web
-                env_web[e.prop_value] = has_web
-            if env_web[e.prop_value]:
-                #result["nodes"][e.node_name]["url"] = "http://%s:8181" % result["nodes"][e.node_name]["ip"]
+                env_web[c.environment] = has_web
+            if env_web[c.environment]:
+                #result["nodes"][c.node_name]["url"] = "http://%s:8181" % result["nodes"][c.node_name]["ip"]
                 # Hack for the PiSeduce cluster
-                result["nodes"][e.node_name]["url"] = "https://pi%02d.seduce.fr" % (
-                        int(result["nodes"][e.node_name]["port_number"]))
-        result["nodes"][e.node_name][e.prop_name] = e.prop_value
+                result["nodes"][c.node_name]["url"] = "https://pi%02d.seduce.fr" % (
+                        int(result["nodes"][c.node_name]["port_number"]))
+            result["nodes"][c.node_name]["environment"] = c.environment
+        if c.os_password is not None:
+            result["nodes"][c.node_name]["os_password"] = c.os_password
     close_session(db)
     return json.dumps(result)
 
@@ -486,28 +495,19 @@ def node_reserve(arg_dict):
                 nodes = query.all()
         for n in nodes:
             filtered_nodes.append(n.name)
-    # Check the availability of the filtered nodes
+    # Check the availability of the filtered nodes from the existing reservations (one query)
     logging.warning("Filtered nodes: %s" % filtered_nodes)
-    selected_nodes = []
-    for node_name in filtered_nodes:
-        ok_selected = True
-        # Move the start date back 15 minutes to give the time for destroying the previous reservation
-        back_date = start_date - 15 * 60
-        # Check the schedule of the existing reservations
-        for reservation in db.query(Schedule).filter(Schedule.node_name == node_name).all():
-            # Only one reservation for a specific node per user
-            if reservation.owner == user:
-                ok_selected = False
-            # There is a reservation at the same date
-            if (back_date > reservation.start_date and back_date < reservation.end_date) or (
-                back_date < reservation.start_date and end_date > reservation.start_date):
-                ok_selected = False
-        if ok_selected:
-            # Add the node to the reservation
-            selected_nodes.append(node_name)
-            if len(selected_nodes) == nb_nodes:
-                # Exit when the required number of nodes is reached
-                break;
+    reservations = {}
+    for sch in db.query(Schedule.node_name, Schedule.start_date, Schedule.end_date, Schedule.owner).all():
+        if sch.node_name not in reservations:
+            reservations[sch.node_name] = []
+        reservations[sch.node_name].append({
+            "start_date": sch.start_date,
+            "end_date": sch.end_date,
+            "owner": sch.owner
+        })
+    selected_nodes = select_nodes(index_reservations(reservations), filtered_nodes, nb_nodes,
+        start_date, end_date, user)
     logging.warning("Selected nodes: %s" % selected_nodes)
     # Reserve the nodes
     for node_name in selected_nodes:
@@ -520,34 +520,32 @@ def node_reserve(arg_dict):
         res.action_state = ""
         db.add(res)
     close_session(db)
+    # Wake up the executor to process the modifications
+    notify_executor()
     result["nodes"] = selected_nodes
     return json.dumps(result)
 
 
 def node_schedule(arg_dict):
-    result = { "nodes": {} }
-    db = open_session()
-    for sch in db.query(Schedule).all():
-        if sch.node_name not in result["nodes"]:
-            result["nodes"][sch.node_name] = {}
-        # Round the end_date up to the next hour
-        remains = sch.end_date % 3600
-        if remains == 0:
-            end_date_comp = sch.end_date
-        else:
-            end_date_comp = sch.end_date - remains + 3600
-        # Iterate over hours between start_date and end_date
-        hours_added = 0
-        while sch.start_date + hours_added * 3600 < end_date_comp:
-            new_date = sch.start_date + hours_added * 3600
-            result["nodes"][sch.node_name][new_date] = {
-                "owner": sch.owner,
-                "start_hour": sch.start_date,
-                "end_hour": sch.end_date
-            }
-            hours_added += 1
-    close_session(db)
-    return json.dumps(result)
+    if arg_dict is None:
+        arg_dict = {}
+    try:
+        win_start, win_end = schedule_window(arg_dict)
+    except ValueError as e:
+        return json.dumps({ "error": str(e) })
+    # Read the reservations of the time window while the response is sent
+    def read_reservations():
+        db = open_session()
+        try:
+            query = db.query(Schedule.node_name, Schedule.start_date, Schedule.end_date, Schedule.owner
+                ).filter(Schedule.end_date > win_start)
+            if win_end is not None:
+                query = query.filter(Schedule.start_date < win_end)
+            for sch in query.order_by(Schedule.node_name, Schedule.start_date).yield_per(500):
+                yield (sch.node_name, sch.start_date, sch.end_date, sch.owner)
+        finally:
+            close_session(db)
+    return schedule_response(read_reservations(), arg_dict)
 
 
 def node_state(arg_dict):
@@ -579,31 +577,35 @@ def node_state(arg_dict):
             if n.action_state is not None and len(n.action_state) > 0:
                 result["nodes"][n.node_name]["state"] = n.action_state
     # Get both the OS password and the environment copy progress of the nodes
-    action_props = db.query(ActionProperty
-            ).filter(ActionProperty.node_name.in_(result["nodes"].keys())
-            ).filter(ActionProperty.prop_name.in_(["os_password", "percent"])).all()
-    for prop in action_props:
-        result["nodes"][prop.node_name][prop.prop_name] = prop.prop_value
+    progress = load_progress()
+    confs = db.query(NodeConf).filter(NodeConf.node_name.in_(result["nodes"].keys())).all()
+    for c in confs:
+        if c.os_password is not None:
+            result["nodes"][c.node_name]["os_password"] = c.os_password
+        if c.node_name in progress:
+            # The copy is running, the executor publishes its progress in memory
+            node_progress = progress[c.node_name]
+            result["nodes"][c.node_name]["percent"] = str(node_progress["percent"])
+            result["nodes"][c.node_name]["copied"] = node_progress["bytes"]
+            result["nodes"][c.node_name]["total"] = node_progress["total"]
+            if node_progress["eta"] is not None:
+                result["nodes"][c.node_name]["eta"] = node_progress["eta"]
+        elif c.percent is not None:
+            # The progress value is sent as a string (as the ActionProperty values)
+            result["nodes"][c.node_name]["percent"] = str(c.percent)
     close_session(db)
     return json.dumps(result)
 
 
 def node_temperature(arg_dict):
-    result = []
-    # Configure the influx client
-    influx = InfluxDBClient(host="localhost", port=8086)
-    influx_dbs = [info["name"] for info in influx.get_list_database()]
-    if "monitoring" not in influx_dbs:
-        logging.error("No 'monitoring' database")
+    # The temperatures are averaged on a resolution chosen from the period
+    try:
+        result = query_mean("temperature_C", "consumption", [ "node" ], arg_dict.get("period"))
+    except:
+        logging.exception("Can not read the node temperatures")
         return json.dumps({})
-    influx_query = "SELECT * FROM temperature_C WHERE "
-    if "period" in arg_dict:
-        influx_query += "time > now() - %s " % arg_dict["period"]
-    else:
-        influx_query += "time > now() - 1h "
-    influx.switch_database('monitoring')
-    influx_res = influx.query(influx_query, epoch="s")
-    result += list(influx_res.get_points())
+    if result is None:
+        return json.dumps({ "parameters": "period: '1h' (number followed by s, m, h, d or w)" })
     return json.dumps(result)
 
 
@@ -621,21 +623,15 @@ def switch_list(arg_dict):
 
 
 def switch_consumption(arg_dict):
-    result = []
-    # Configure the influx client
-    influx = InfluxDBClient(host="localhost", port=8086)
-    influx_dbs = [info["name"] for info in influx.get_list_database()]
-    if "monitoring" not in influx_dbs:
-        logging.error("No 'monitoring' database")
-        return json.dumps({})
-    influx_query = "SELECT * FROM power_W WHERE "
-    if "period" in arg_dict:
-        influx_query += "time > now() - %s " % arg_dict["period"]
-    else:
-        influx_query += "time > now() - 1h "
+    filters = {}
     if "switch" in arg_dict:
-        influx_query += "AND switch = '%s'" % arg_dict["switch"]
-    influx.switch_database('monitoring')
-    influx_res = influx.query(influx_query, epoch="s")
-    result += list(influx_res.get_points())
+        filters["switch"] = arg_dict["switch"]
+    # The consumptions are averaged on a resolution chosen from the period
+    try:
+        result = query_mean("power_W", "consumption", [ "port", "switch" ], arg_dict.get("period"), filters)
+    except:
+        logging.exception("Can not read the switch consumptions")
+        return json.dumps({})
+    if result is None:
+        return json.dumps({ "parameters": "period: '1h' (number followed by s, m, h, d or w)" })
     return json.dumps(result)
@@ -1,14 +1,28 @@
-from database.tables import ActionProperty, RaspNode, RaspEnvironment
+from database.connector import context_conf, context_conf_value
+from database.tables import Action, RaspEnvironment, RaspNode
 from datetime import datetime
 from glob import glob
 from lib.config_loader import get_config
+from lib.copy_progress import copy_progress, forget_copy, watch_copy
+from lib.image_store import COMPRESSORS, data_size, load_manifest, mbr_partitions, read_chunks_command
+from lib.image_store import read_command, remove_manifest, store_image_safe, sync_script, write_script
+from lib.ssh_pool import ssh_connect, ssh_invalidate
 from lib.switch_snmp import turn_on_port, turn_off_port
 from paramiko.ssh_exception import BadHostKeyException, AuthenticationException, SSHException
-from raspberry.states import SSH_IDX
-import logging, os, paramiko, random, shutil, socket, string, subprocess, time
+from raspberry.states import COPY_IDX, SSH_IDX
+import base64, logging, os, random, shutil, socket, string, subprocess, threading, time
 
 # SSH timeout in seconds
 SSH_TIMEOUT = 3
+# TCP port used by the nodes to relay the environment images (see 'env_relay')
+RELAY_PORT = 5050
+# Number of connection attempts (one per second) of the nodes receiving the image from the previous node
+RELAY_RETRIES = 60
+# The nodes sending the image close the connections idle during this number of seconds
+RELAY_TIMEOUT = 60
+# The nodes whose copy is started by the relay chain of another node: { node_name: start_date }
+RELAY_STARTED = {}
+RELAY_LOCK = threading.Lock()
 
 # Test if the processus exists on the remote node
 def ps_ssh(ssh_session, process):
@@ -21,6 +35,28 @@ def ps_ssh(ssh_session, process):
         return -1
 
 
+# Install the script pushing the telemetry of the node to the agent API (see api/telemetry_v1.py)
+def install_telemetry(ssh, action, pimaster):
+    with open("admin/telemetry-push.sh", "r") as script_file:
+        script = script_file.read()
+    script = script.replace("@PIMASTER_IP@", pimaster.ip).replace("@NODE_NAME@", action.node_name)
+    script = script.replace("@API_PORT@", str(get_config()["port_number"]))
+    with open("admin/telemetry-push.service", "r") as service_file:
+        service = service_file.read()
+    sftp = ssh.open_sftp()
+    with sftp.open("fs_dir/usr/local/bin/telemetry-push.sh", "w") as remote_file:
+        remote_file.write(script)
+    sftp.chmod("fs_dir/usr/local/bin/telemetry-push.sh", 0o755)
+    with sftp.open("fs_dir/etc/systemd/system/telemetry-push.service", "w") as remote_file:
+        remote_file.write(service)
+    sftp.close()
+    # Enable the service
+    cmd = "ln -sf /etc/systemd/system/telemetry-push.service \
+        fs_dir/etc/systemd/system/multi-user.target.wants/telemetry-push.service"
+    (stdin, stdout, stderr) = ssh.exec_command(cmd)
+    return_code = stdout.channel.recv_exit_status()
+
+
 # Generate a random string of letters and digits
 def new_password(stringLength=8):
     lettersAndDigits = string.ascii_letters + string.digits
@@ -28,8 +64,8 @@ def new_password(stringLength=8):
 
 
 # States of the 'deploy' process (deploy environments)
-def boot_conf_exec(action, db):
-    serial = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first().serial
+def boot_conf_exec(action, db, ctx):
+    serial = ctx["nodes"][action.node_name].serial
     # Create a folder containing network boot files that will be served via TFTP
     tftpboot_template_folder = "/tftpboot/rpiboot_uboot"
     tftpboot_node_folder = "/tftpboot/%s" % serial
@@ -41,31 +77,35 @@ def boot_conf_exec(action, db):
     return True
 
 
-def turn_off_exec(action, db):
-    node = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first()
+def turn_off_exec(action, db, ctx):
+    node = ctx["nodes"][action.node_name]
     # Turn off port
     turn_off_port(node.switch, node.port_number)
+    # The SSH connections to the node are lost
+    ssh_invalidate(node.ip)
     return True
 
 
-def turn_on_exec(action, db):
-    node = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first()
+def turn_on_exec(action, db, ctx):
+    node = ctx["nodes"][action.node_name]
     # Turn on port
     turn_on_port(node.switch, node.port_number)
+    # Do not reuse the SSH connections opened before the reboot
+    ssh_invalidate(node.ip)
     return True
 
 
-def turn_on_post(action, db):
-    node_ip = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first().ip
+def turn_on_post(action, db, ctx):
+    node_ip = ctx["nodes"][action.node_name].ip
     cmd = "ping -W 1 -c 1 %s" % node_ip
     subproc = subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return subproc.returncode == 0
 
 
-def ssh_test_post(action, db):
-    node_ip = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first().ip
+def ssh_test_post(action, db, ctx):
+    node_ip = ctx["nodes"][action.node_name].ip
     # By default, we use the ssh_user of the environment. We assume the environment is deployed
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
+    ssh_user = ctx["envs"][action.environment].ssh_user
     expected_hostname = action.node_name
     # Check if the node boots from the NFS filesystem
     if action.process == "deploy":
@@ -73,123 +113,286 @@ def ssh_test_post(action, db):
             ssh_user = "root"
             expected_hostname = "nfspi"
     elif action.process == "reboot":
-        if action.reboot_state is not None and len(action.reboot_state) > 0:
-            state_info = action.reboot_state.split("?!")
+        reboot_state = None
+        if action.node_name in ctx["confs"]:
+            reboot_state = ctx["confs"][action.node_name].reboot_state
+        if reboot_state is not None and len(reboot_state) > 0:
+            state_info = reboot_state.split("?!")
             if len(state_info) == 2 and state_info[0] == "deploy" and int(state_info[1]) <= SSH_IDX:
                 ssh_user = "root"
                 expected_hostname = "nfspi"
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(node_ip, ssh_user, SSH_TIMEOUT)
         (stdin, stdout, stderr) = ssh.exec_command("cat /etc/hostname")
         return_code = stdout.channel.recv_exit_status()
         myname = stdout.readlines()[0].strip()
-        ssh.close()
         if myname == expected_hostname:
             return True
         else:
             logging.error("[%s] wrong filesystem (expected: %s, found: %s)" % (
                 action.node_name, expected_hostname, myname))
+            # The connection is opened to the wrong filesystem
+            ssh_invalidate(node_ip)
             return False
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(node_ip)
     return False
 
 
-def env_copy_exec(action, db):
-    env_path = get_config()["env_path"]
-    node_ip = db.query(RaspNode).filter(RaspNode.name == action.node_name).first().ip
-    # WARN: the pimaster SSH user is in pimaster.switch (sorry)
-    pimaster = db.query(RaspNode).filter(RaspNode.name == "pimaster").first()
-    env = db.query(RaspEnvironment).filter(RaspEnvironment.name  == action.environment).first()
+# Upload the script writing the data chunks of the stored image on the SD card
+def upload_write_script(ssh, node_name, manifest):
+    sftp = ssh.open_sftp()
+    with sftp.open("write-%s.sh" % node_name, "w") as remote_file:
+        remote_file.write(write_script(manifest))
+    sftp.close()
+
+
+# Build the command writing the environment image on the SD card of the node
+# manifest: the manifest of the stored image (None: send the archive of the environment)
+# from_ip: the node sending the compressed image (None: read the image from the pimaster)
+# next_ip: the node receiving a copy of the compressed image (None: end of the relay chain)
+# The nodes sending the image listen on RELAY_PORT, the next nodes connect to them
+def copy_command(node_name, pimaster, env, manifest, from_ip = None, next_ip = None):
+    if from_ip is None:
+        if manifest is None:
+            read_cmd = "cat %s%s" % (get_config()["env_path"], env.img_name)
+        else:
+            read_cmd = read_command(env.img_name)
+        # WARN: the pimaster SSH user is in pimaster.switch (sorry)
+        source = "rsh -o StrictHostKeyChecking=no %s@%s '%s'" % (pimaster.switch, pimaster.ip, read_cmd)
+    else:
+        # Connect to the previous node until it listens (netcat-openbsd, -d: do not read stdin)
+        source = "(for i in $(seq %d); do nc -d %s %d && break; sleep 1; done)" % (
+            RELAY_RETRIES, from_ip, RELAY_PORT)
+    relay = ""
+    if next_ip is not None:
+        # Send the compressed image to the next node while writing it
+        # -N: close the connection at the end of the image, so the copy of the next node ends
+        # -w: close the connection if the next node does not read the image
+        fifo = "relay-%s.fifo" % node_name
+        relay = "rm -f %s; mkfifo %s; nc -N -w %d -l -p %d < %s & RELAY_PID=$!; " % (
+            fifo, fifo, RELAY_TIMEOUT, RELAY_PORT, fifo)
+        # The next node connects during the first RELAY_RETRIES seconds, stop the listener if it is still
+        # listening (the connection is not accepted)
+        relay += "(sleep %d; grep -qs ':%04X 0*:0000 0A' /proc/net/tcp /proc/net/tcp6 && kill $RELAY_PID) & " % (
+            RELAY_RETRIES, RELAY_PORT)
+        # -p: the failure of the relay does not stop the copy of this node (coreutils tee)
+        source += " | tee -p %s" % fifo
+    if manifest is None:
+        return "%s%s | tar xzOf - | pv -n -b -s %s 2> progress-%s.txt | dd of=/dev/mmcblk0 bs=4M conv=fsync &" % (
+            relay, source, env.img_size, node_name)
+    # Decompress the data chunks and write them at their offsets (the device name is in the command line of
+    # the script to detect the running copies with ps)
+    return "%s%s | %s | pv -n -b -s %d 2> progress-%s.txt | sh write-%s.sh /dev/mmcblk0 &" % (
+        relay, source, COMPRESSORS[manifest["compressor"]][1], data_size(manifest), node_name, node_name)
+
+
+# Start the copy of the environment on the nodes: [ (node_name, node_ip) ]
+# The pimaster sends the image to the first node of every chain, every node sends it to the next node
+# Return the names of the nodes whose copy is started
+def start_relay_chains(nodes, pimaster, env):
+    started = []
+    manifest = load_manifest(env.img_name)
+    # Connect to the nodes before building the chains
+    chain_nodes = []
+    for node_name, node_ip in nodes:
+        try:
+            ssh = ssh_connect(node_ip, "root", SSH_TIMEOUT)
+            if ps_ssh(ssh, "mmcblk0") > 0:
+                # The copy is already running (executor restart)
+                started.append(node_name)
+            else:
+                chain_nodes.append((node_name, node_ip, ssh))
+        except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
+            logging.warning("[%s] SSH connection failed" % node_name)
+            ssh_invalidate(node_ip)
+    chain_length = get_config().get("env_relay_chain", 8)
+    for idx in range(0, len(chain_nodes), chain_length):
+        chain = chain_nodes[idx:idx + chain_length]
+        logging.info("copy %s to the SDCARD of the chain %s" % (env.img_name, [ n[0] for n in chain ]))
+        # Start the end of the chain first: the nodes retry to connect until the previous node listens
+        for pos in reversed(range(len(chain))):
+            node_name, node_ip, ssh = chain[pos]
+            from_ip = chain[pos - 1][1] if pos > 0 else None
+            next_ip = chain[pos + 1][1] if pos + 1 < len(chain) else None
+            try:
+                if manifest is not None:
+                    upload_write_script(ssh, node_name, manifest)
+                (stdin, stdout, stderr) = ssh.exec_command(
+                    copy_command(node_name, pimaster, env, manifest, from_ip, next_ip))
+                return_code = stdout.channel.recv_exit_status()
+                started.append(node_name)
+            except (SSHException, socket.error) as e:
+                logging.warning("[%s] SSH connection failed" % node_name)
+                ssh_invalidate(node_ip)
+    return started
+
+
+# Rewrite only the blocks that differ from the stored image when the SD card has the partitions of the image
+# (re-deployment of the same environment). Return False if the whole image must be copied
+def incremental_exec(action, db, ctx):
+    node_ip = ctx["nodes"][action.node_name].ip
+    pimaster = ctx["nodes"]["pimaster"]
+    env = ctx["envs"][action.environment]
+    manifest = load_manifest(env.img_name)
+    if manifest is None or len(manifest.get("partitions", [])) < 2:
+        return False
+    try:
+        ssh = ssh_connect(node_ip, "root", SSH_TIMEOUT)
+        if ps_ssh(ssh, "mmcblk0") > 0:
+            # The copy is already running (executor restart)
+            return True
+        (stdin, stdout, stderr) = ssh.exec_command("dd if=/dev/mmcblk0 bs=512 count=1 2> /dev/null | base64")
+        return_code = stdout.channel.recv_exit_status()
+        partitions = mbr_partitions(base64.b64decode("".join(stdout.readlines())))
+        # The second partition is resized after the copy, compare its type and its first sector
+        img_partitions = manifest["partitions"]
+        if len(partitions) < 2 or partitions[0] != img_partitions[0] or partitions[1][:2] != img_partitions[1][:2]:
+            logging.info("[%s] the partition table differs from %s" % (action.node_name, env.img_name))
+            return False
+        logging.info("[%s] rewrite the blocks that differ from %s" % (action.node_name, env.img_name))
+        # WARN: the pimaster SSH user is in pimaster.switch (sorry)
+        # The differing chunks are sent in one stream
+        read_cmd = "rsh -o StrictHostKeyChecking=no %s@%s \"%s\"" % (pimaster.switch, pimaster.ip, read_chunks_command())
+        sftp = ssh.open_sftp()
+        with sftp.open("sync-%s.sh" % action.node_name, "w") as remote_file:
+            remote_file.write(sync_script(manifest, read_cmd, "progress-%s.txt" % action.node_name,
+                "sync-%s.list" % action.node_name))
+        sftp.close()
+        (stdin, stdout, stderr) = ssh.exec_command(
+            "sh sync-%s.sh /dev/mmcblk0 > /dev/null 2>&1 &" % action.node_name)
+        return_code = stdout.channel.recv_exit_status()
+        context_conf(db, ctx, action.node_name).percent = 0
+        return True
+    except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
+        logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(node_ip)
+    return False
+
+
+def env_copy_exec(action, db, ctx):
+    if get_config().get("env_incremental", True) and incremental_exec(action, db, ctx):
+        return True
+    if get_config().get("env_relay", False):
+        return env_relay_exec(action, db, ctx)
+    node_ip = ctx["nodes"][action.node_name].ip
+    pimaster = ctx["nodes"]["pimaster"]
+    env = ctx["envs"][action.environment]
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(node_ip, username = "root", timeout = SSH_TIMEOUT)
-        # Get the path to the IMG file
-        img_path = env_path + env.img_name
-        logging.info("[%s] copy %s to the SDCARD" % (action.node_name, img_path))
+        ssh = ssh_connect(node_ip, "root", SSH_TIMEOUT)
+        logging.info("[%s] copy %s to the SDCARD" % (action.node_name, env.img_name))
+        manifest = load_manifest(env.img_name)
+        if manifest is not None:
+            upload_write_script(ssh, action.node_name, manifest)
         # Write the image of the environment on SD card
-        deploy_cmd = "rsh -o StrictHostKeyChecking=no %s@%s 'cat %s' | tar xzOf - | \
-            pv -n -p -s %s 2> progress-%s.txt | dd of=/dev/mmcblk0 bs=4M conv=fsync &" % (
-            pimaster.switch, pimaster.ip, img_path, env.img_size, action.node_name)
-        (stdin, stdout, stderr) = ssh.exec_command(deploy_cmd)
+        (stdin, stdout, stderr) = ssh.exec_command(copy_command(action.node_name, pimaster, env, manifest))
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
-        act_prop = db.query(ActionProperty
-            ).filter(ActionProperty.node_name == action.node_name
-            ).filter(ActionProperty.prop_name == "percent").first()
-        if act_prop is None:
-            owner_email = db.query(ActionProperty
-                ).filter(ActionProperty.node_name == action.node_name
-                ).first().owner
-            act_prop = ActionProperty()
-            act_prop.node_name = action.node_name
-            act_prop.prop_name = "percent"
-            act_prop.prop_value = 0
-            act_prop.owner = owner_email
-            db.add(act_prop)
-        else:
-            act_prop.prop_value = 0
+        context_conf(db, ctx, action.node_name).percent = 0
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
+    return True
+
+
+# Return the nodes of the relay chains started by the action: [ (node_name, node_ip) ]
+# The first node is the node of the action, then the nodes waiting in the 'env_copy' state for the same environment
+def relay_nodes(action, db, ctx):
+    # The actions store the state name ('env_copy'), the function name is also accepted
+    waiting = [ a.node_name for a in db.query(Action.node_name
+        ).filter(Action.state.in_([ "env_copy", "env_copy_exec" ])
+        ).filter(Action.environment == action.environment
+        ).filter(Action.node_name != action.node_name
+        ).all() if a.node_name not in RELAY_STARTED ]
+    nodes = [ (action.node_name, ctx["nodes"][action.node_name].ip) ]
+    nodes += [ (n.name, n.ip) for n in db.query(RaspNode).filter(RaspNode.name.in_(waiting)).all() ]
+    return nodes
+
+
+# Copy the environment to all the nodes deploying it at the same time with relay chains
+def env_relay_exec(action, db, ctx):
+    pimaster = ctx["nodes"]["pimaster"]
+    env = ctx["envs"][action.environment]
+    with RELAY_LOCK:
+        # Forget the chains started more than one hour ago
+        for node_name in [ n for n, d in RELAY_STARTED.items() if d < time.time() - 3600 ]:
+            del RELAY_STARTED[node_name]
+        if RELAY_STARTED.pop(action.node_name, None) is None:
+            # Wait for the nodes of the same environment that are not ready to copy it
+            waited = int(time.time()) - (action.updated_at or int(time.time()))
+            if waited < get_config().get("env_relay_wait", 0) and db.query(Action.node_name
+                ).filter(Action.process == "deploy"
+                ).filter(Action.environment == action.environment
+                ).filter(Action.state_idx < COPY_IDX
+                ).filter(Action.state != "lost"
+                ).first() is not None:
+                return False
+            # Start the copy of the nodes waiting for this environment
+            started = start_relay_chains(relay_nodes(action, db, ctx), pimaster, env)
+            for node_name in started:
+                if node_name != action.node_name:
+                    RELAY_STARTED[node_name] = time.time()
+            if action.node_name not in started:
+                return False
+    context_conf(db, ctx, action.node_name).percent = 0
     return True
 
 
-def env_copy_post(action, db):
+def env_copy_post(action, db, ctx):
     ret_fct = False
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         if ps_ssh(ssh, "mmcblk0") > 0:
             ret_fct = True
-        ssh.close()
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return ret_fct
 
 
-def env_check_exec(action, db):
-    ret_fct = False
-    img_size = db.query(RaspEnvironment).filter(RaspEnvironment.name  == action.environment).first().img_size
-    percent_prop = db.query(ActionProperty
-        ).filter(ActionProperty.node_name  == action.node_name
-        ).filter(ActionProperty.prop_name  == "percent"
-        ).first()
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
-        if ps_ssh(ssh, "mmcblk0") == 0:
-            ret_fct = True
+# Command writing the number of bytes copied to the SD card every 2 seconds, then the final number of bytes and
+# 'done' at the end of the copy
+# WARN: the pattern must not match this command
+def progress_command(node_name):
+    return ("while [ $(ps aux | grep 'mmcblk[0]' | wc -l) -gt 0 ]; do tail -n 1 progress-%s.txt 2> /dev/null; " +
+        "sleep 2; done; tail -n 1 progress-%s.txt 2> /dev/null; echo done") % (node_name, node_name)
+
+
+def env_check_exec(action, db, ctx):
+    progress = copy_progress(action.node_name)
+    if progress is None:
+        # Open the channel sending the progress of the copy
+        env = ctx["envs"][action.environment]
+        manifest = load_manifest(env.img_name)
+        if manifest is None:
+            total = env.img_size
         else:
-            cmd = "tail -n 1 progress-%s.txt" % action.node_name
-            (stdin, stdout, stderr) = ssh.exec_command(cmd)
-            return_code = stdout.channel.recv_exit_status()
-            output = stdout.readlines()
-            if len(output) == 0:
-                logging.warning("%s: no progress value for the running environment copy" % action.node_name)
-                elapsedTime = int(time.time()) - action.updated_at
-                # Compute the progress value with an assumed transfert rate of 8 MB/s
-                percent = round(elapsedTime * 8000000 * 100 / img_size)
-            else:
-                percent = output[0].strip()
-            percent_prop.prop_value = percent
-        ssh.close()
-    except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
-        logging.warning("[%s] SSH connection failed" % action.node_name)
-    return ret_fct
+            # Only the data chunks are copied
+            total = data_size(manifest)
+        try:
+            ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
+            watch_copy(action.node_name, ssh, progress_command(action.node_name), total)
+        except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
+            logging.warning("[%s] SSH connection failed" % action.node_name)
+            ssh_invalidate(action.node_ip)
+        return False
+    if progress["done"]:
+        forget_copy(action.node_name)
+        if progress["bytes"] < progress["total"]:
+            # The image stream is truncated (failure of the pimaster or of the previous node of the relay chain)
+            logging.error("[%s] incomplete copy: %d/%d bytes" % (action.node_name, progress["bytes"], progress["total"]))
+            return False
+        context_conf(db, ctx, action.node_name).percent = 100
+        return True
+    return False
 
 
-def delete_partition_exec(action, db):
+def delete_partition_exec(action, db, ctx):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         # Register the size of the existing partition
-        cmd = "rm progress-%s.txt; fdisk -l /dev/mmcblk0" % action.node_name
+        cmd = "rm progress-%s.txt; rm -f relay-%s.fifo write-%s.sh sync-%s.sh sync-%s.list; fdisk -l /dev/mmcblk0" % (
+            action.node_name, action.node_name, action.node_name, action.node_name, action.node_name)
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
         output = stdout.readlines()
@@ -198,26 +401,21 @@ def delete_partition_exec(action, db):
             cmd = "(echo d; echo 2; echo w) | fdisk -u /dev/mmcblk0"
             (stdin, stdout, stderr) = ssh.exec_command(cmd)
             return_code = stdout.channel.recv_exit_status()
-            ssh.close()
         else:
             logging.info("[%s] No second partition detected" % action.node_name)
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def create_partition_exec(action, db):
-    sector_start = db.query(RaspEnvironment
-        ).filter(RaspEnvironment.name  == action.environment).first().sector_start
-    size_str = db.query(ActionProperty
-        ).filter(ActionProperty.node_name  == action.node_name
-        ).filter(ActionProperty.prop_name == "part_size"
-        ).first().prop_value
+def create_partition_exec(action, db, ctx):
+    sector_start = ctx["envs"][action.environment].sector_start
+    # Without size, the partition uses the whole free space
+    size_str = context_conf_value(ctx, action.node_name, "part_size", "")
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         if "gb" in size_str:
             part_size = int(size_str.replace("gb", "")) * 1024
             # Total size of the new partition in sectors (512B)
@@ -233,18 +431,16 @@ def create_partition_exec(action, db):
         cmd = "partprobe"
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def mount_partition_exec(action, db):
+def mount_partition_exec(action, db, ctx):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         # Update the deployment
         cmd = "mount /dev/mmcblk0p1 boot_dir"
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
@@ -252,18 +448,16 @@ def mount_partition_exec(action, db):
         cmd = "mount /dev/mmcblk0p2 fs_dir"
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def mount_partition_post(action, db):
+def mount_partition_post(action, db, ctx):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         # Check the boot_dir mount point
         cmd = "ls boot_dir/ | wc -l"
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
@@ -292,30 +486,27 @@ def mount_partition_post(action, db):
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def resize_partition_exec(action, db):
+def resize_partition_exec(action, db, ctx):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         cmd = "resize2fs /dev/mmcblk0p2 &> /dev/null &"
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def resize_partition_post(action, db):
+def resize_partition_post(action, db, ctx):
     try:
         ret_fct = False
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         if ps_ssh(ssh, "resize2fs") > 0:
             ret_fct = True
         else:
@@ -327,52 +518,34 @@ def resize_partition_post(action, db):
             if len(output) > 2:
                 if 'Nothing to do!' in output[1]:
                     ret_fct = True
-        ssh.close()
         return ret_fct
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def wait_resizing_exec(action, db):
+def wait_resizing_exec(action, db, ctx):
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         ret_fct = False
         if ps_ssh(ssh, "resize2fs") == 0:
             ret_fct = True
-        ssh.close()
         return ret_fct
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def system_conf_exec(action, db):
-    pwd = db.query(ActionProperty
-        ).filter(ActionProperty.node_name  == action.node_name
-        ).filter(ActionProperty.prop_name == "os_password"
-        ).first()
-    os_password = ""
-    if pwd is None:
+def system_conf_exec(action, db, ctx):
+    node_conf = context_conf(db, ctx, action.node_name)
+    if node_conf.os_password is None:
         # Generate the password
-        os_password = new_password()
-        owner_email = db.query(ActionProperty
-            ).filter(ActionProperty.node_name == action.node_name
-            ).first().owner
-        act_prop = ActionProperty()
-        act_prop.node_name = action.node_name
-        act_prop.prop_name = "os_password"
-        act_prop.prop_value = os_password
-        act_prop.owner = owner_email
-        db.add(act_prop)
-    else:
-        os_password = pwd.prop_value
+        node_conf.os_password = new_password()
+    os_password = node_conf.os_password
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         if action.environment.startswith("picore"):
             # Set the hostname to modify the bash prompt
             cmd = "sed -i 's/$/ host=%s/g' boot_dir/cmdline3.txt" % action.node_name
@@ -419,6 +592,9 @@ def system_conf_exec(action, db):
             cmd = "cp /root/.ssh/authorized_keys fs_dir/root/.ssh/authorized_keys"
             (stdin, stdout, stderr) = ssh.exec_command(cmd)
             return_code = stdout.channel.recv_exit_status()
+        if get_config().get("telemetry_push", False) and \
+            (action.environment.startswith("raspbian") or action.environment.startswith("ubuntu")):
+            install_telemetry(ssh, action, ctx["nodes"]["pimaster"])
         if action.environment == "raspbian_cloud9":
             cmd = "sed -i 's/-a :/-a admin:%s/' fs_dir/etc/systemd/system/cloud9.service" % os_password
             (stdin, stdout, stderr) = ssh.exec_command(cmd)
@@ -429,11 +605,12 @@ def system_conf_exec(action, db):
             return_code = stdout.channel.recv_exit_status()
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return True
 
 
-def boot_files_exec(action, db):
-    serial = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first().serial
+def boot_files_exec(action, db, ctx):
+    serial = ctx["nodes"][action.node_name].serial
     # Copy boot files to the tftp directory
     tftpboot_node_folder = "/tftpboot/%s" % serial
     # Delete the existing tftp directory
@@ -444,12 +621,11 @@ def boot_files_exec(action, db):
     subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     # Reboot to initialize the operating system
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
         (stdin, stdout, stderr) = ssh.exec_command("reboot")
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
+        # The node reboots from the SD card filesystem
+        ssh_invalidate(action.node_ip)
         # Waiting for the node is turned off
         ret = 0
         max_attempt = 10
@@ -461,29 +637,17 @@ def boot_files_exec(action, db):
         return ret != 0
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.exception("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def user_conf_exec(action, db):
-    act_prop = db.query(ActionProperty
-        ).filter(ActionProperty.node_name  == action.node_name
-        ).filter(ActionProperty.prop_name.in_(["os_password", "form_ssh_key", "account_ssh_key" ])
-        ).all()
-    os_password = None
-    form_ssh_key = None
-    account_ssh_key = None
-    for prop in act_prop:
-        if prop.prop_name == "os_password":
-            os_password = prop.prop_value
-        elif prop.prop_name == "form_ssh_key":
-            form_ssh_key = prop.prop_value
-        elif prop.prop_name == "account_ssh_key":
-            account_ssh_key = prop.prop_value
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name  == action.environment).first().ssh_user
+def user_conf_exec(action, db, ctx):
+    os_password = context_conf_value(ctx, action.node_name, "os_password")
+    form_ssh_key = context_conf_value(ctx, action.node_name, "form_ssh_key")
+    account_ssh_key = context_conf_value(ctx, action.node_name, "account_ssh_key")
+    ssh_user = ctx["envs"][action.environment].ssh_user
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
         # Get the user SSH key from the DB
         my_ssh_keys = ""
         # Copy the SSH key provided in the configuring form
@@ -509,21 +673,19 @@ def user_conf_exec(action, db):
             cmd = "echo -e '%s\n%s' | passwd pi" % (os_password, os_password)
             (stdin, stdout, stderr) = ssh.exec_command(cmd)
             return_code = stdout.channel.recv_exit_status()
-        ssh.close()
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
 # Destroying deployments
-def destroying_exec(action, db):
-    node = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first()
+def destroying_exec(action, db, ctx):
+    node = ctx["nodes"][action.node_name]
     if action.environment is not None:
-        ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name  == action.environment).first().ssh_user
+        ssh_user = ctx["envs"][action.environment].ssh_user
         # When destroying initialized deployments, the environment is unset
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         if node.model.startswith("RPI3"):
             # Delete the bootcode.bin file
             try:
@@ -531,15 +693,15 @@ def destroying_exec(action, db):
                 if action.environment.startswith("ubuntu"):
                     cmd = "rm /boot/firmware/bootcode.bin && sync"
                 # Try to connect to the deployed environment
-                ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+                ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
                 (stdin, stdout, stderr) = ssh.exec_command(cmd)
                 return_code = stdout.channel.recv_exit_status()
-                ssh.close()
             except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
                 logging.info("[%s] can not connect to the deployed environment" % action.node_name)
+                ssh_invalidate(action.node_ip, ssh_user)
                 try:
                     # Try to connect to the nfs environment
-                    ssh.connect(action.node_ip, username = "root", timeout = SSH_TIMEOUT)
+                    ssh = ssh_connect(action.node_ip, "root", SSH_TIMEOUT)
                     cmd = "mount /dev/mmcblk0p1 boot_dir"
                     (stdin, stdout, stderr) = ssh.exec_command(cmd)
                     return_code = stdout.channel.recv_exit_status()
@@ -548,14 +710,14 @@ def destroying_exec(action, db):
                         cmd = "rm boot_dir/firmware/bootcode.bin && sync"
                     (stdin, stdout, stderr) = ssh.exec_command(cmd)
                     return_code = stdout.channel.recv_exit_status()
-                    ssh.close()
                 except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
                     logging.info("[%s] can not connect to the NFS environment" % action.node_name)
+                    ssh_invalidate(action.node_ip, "root")
         if node.model.startswith("RPI4"):
             # Check the booloader configuration (netboot)
             try:
                 # Try to connect to the deployed environment
-                ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+                ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
                 # Check the booted system is the NFS system
                 (stdin, stdout, stderr) = ssh.exec_command("cat /etc/hostname")
                 return_code = stdout.channel.recv_exit_status()
@@ -573,9 +735,9 @@ def destroying_exec(action, db):
                             return False
                     else:
                         logging.info("[%s] No boot_order line (environment: %s)" % (action.node_name, action.environment))
-                ssh.close()
             except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
                 logging.info("[%s] can not connect to the deployed environment" % action.node_name)
+                ssh_invalidate(action.node_ip, ssh_user)
     # Delete the tftpboot folder
     tftpboot_node_folder = "/tftpboot/%s" % node.serial
     if os.path.isdir(tftpboot_node_folder):
@@ -584,15 +746,14 @@ def destroying_exec(action, db):
 
 
 # Register environments
-def uncompress_exec(action, db):
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
-    img_path = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == action.node_name
-        ).filter(ActionProperty.prop_name == "img_path").first().prop_value
+def uncompress_exec(action, db, ctx):
+    ssh_user = ctx["envs"][action.environment].ssh_user
+    img_path = context_conf_value(ctx, action.node_name, "img_path")
+    if img_path is None:
+        logging.error("[%s] no image path to register the environment" % action.node_name)
+        return False
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
         cmd = "ls -l %s" % img_path
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
@@ -603,48 +764,40 @@ def uncompress_exec(action, db):
         logging.error(cmd)
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
         return_code = stdout.channel.recv_exit_status()
-        ssh.close()
         return True
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def uncompress_post(action, db):
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
+def uncompress_post(action, db, ctx):
+    ssh_user = ctx["envs"][action.environment].ssh_user
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
         ret_fct = False
         if ps_ssh(ssh, "tar") == 0:
             ret_fct = True
-        ssh.close()
         return ret_fct
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
-def read_info_exec(action, db):
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
-    act_prop = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == action.node_name
-        ).filter(ActionProperty.prop_name.in_(["img_path", "env_name"])
-        ).all()
-    for prop in act_prop:
-        if prop.prop_name == "img_path":
-            img_path = prop.prop_value
-        else:
-            env_name = prop
+def read_info_exec(action, db, ctx):
+    ssh_user = ctx["envs"][action.environment].ssh_user
+    img_path = context_conf_value(ctx, action.node_name, "img_path")
+    if img_path is None:
+        logging.error("[%s] no image path to register the environment" % action.node_name)
+        return False
+    node_conf = context_conf(db, ctx, action.node_name)
     file_name = os.path.basename(img_path)
     img_name = file_name.replace(".tar.gz", "")
     prefix = None
     ssh_user = None
     img_size = None
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
         # Retrieve the first sector number of the second partition
         cmd = "fdisk -l %s" % img_name
         (stdin, stdout, stderr) = ssh.exec_command(cmd)
@@ -676,8 +829,8 @@ def read_info_exec(action, db):
             if len(output) > 7:
                 img_size = int(output[4])
                 # Add the environment to the database
-                new_env_name = "%s%s" % (prefix, env_name.prop_value)
-                env_name.prop_value = new_env_name
+                new_env_name = "%s%s" % (prefix, node_conf.env_name)
+                node_conf.env_name = new_env_name
                 existing = db.query(RaspEnvironment).filter(RaspEnvironment.name == new_env_name).first()
                 if existing is not None:
                     db.delete(existing)
@@ -696,52 +849,54 @@ def read_info_exec(action, db):
                 return False
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
-def img_upload_exec(action, db):
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
+def img_upload_exec(action, db, ctx):
+    ssh_user = ctx["envs"][action.environment].ssh_user
     env_path = get_config()["env_path"]
-    img_path = db.query(ActionProperty
-        ).filter(ActionProperty.node_name == action.node_name
-        ).filter(ActionProperty.prop_name == "img_path").first().prop_value
+    img_path = context_conf_value(ctx, action.node_name, "img_path")
+    if img_path is None:
+        logging.error("[%s] no image path to register the environment" % action.node_name)
+        return False
+    # The chunks of the previous archive must not be sent to the nodes
+    remove_manifest(os.path.basename(img_path))
     cmd = "scp -o 'StrictHostKeyChecking no' root@%s:%s %s" % (action.node_ip, img_path, env_path)
     subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return True
 
 
-def img_upload_post(action, db):
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
+def img_upload_post(action, db, ctx):
+    ssh_user = ctx["envs"][action.environment].ssh_user
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(action.node_ip, username = ssh_user, timeout = SSH_TIMEOUT)
+        ssh = ssh_connect(action.node_ip, ssh_user, SSH_TIMEOUT)
         ret_fct = False
         if ps_ssh(ssh, "scp") == 0:
-            # Delete the action properties
-            act_prop = db.query(ActionProperty
-                ).filter(ActionProperty.node_name == action.node_name
-                ).filter(ActionProperty.prop_name.in_(["img_path", "env_name"])
-                ).all()
-            for prop in act_prop:
-                if prop.prop_name == "env_name":
-                    env_name = prop.prop_value
-                db.delete(prop)
+            # Delete the properties of the 'reg_env' process
+            node_conf = context_conf(db, ctx, action.node_name)
+            env_name = node_conf.env_name
+            node_conf.img_path = None
+            node_conf.env_name = None
             # Update the environment state
             env = db.query(RaspEnvironment).filter(RaspEnvironment.name == env_name).first()
             env.state = "available"
+            # Split the image in compressed chunks to deploy the environment without the archive
+            # The archive is sent to the nodes until the manifest of the image is written
+            threading.Thread(target = store_image_safe,
+                args = (os.path.join(get_config()["env_path"], env.img_name),), daemon = True).start()
             ret_fct = True
-        ssh.close()
         return ret_fct
     except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
         logging.warning("[%s] SSH connection failed" % action.node_name)
+        ssh_invalidate(action.node_ip)
     return False
 
 
 # Update the boot files of the TFTP server
-def update_boot_files_exec(action, db):
-    serial = db.query(RaspNode).filter(RaspNode.name  == action.node_name).first().serial
-    ssh_user = db.query(RaspEnvironment).filter(RaspEnvironment.name == action.environment).first().ssh_user
+def update_boot_files_exec(action, db, ctx):
+    serial = ctx["nodes"][action.node_name].serial
+    ssh_user = ctx["envs"][action.environment].ssh_user
     # Copy boot files to the tftp directory
     tftpboot_node_folder = "/tftpboot/%s" % serial
     # Delete the existing tftp directory
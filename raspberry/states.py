@@ -2,6 +2,8 @@
 # After this state, we use the environment property 'ssh_user' to define the user account to use in SSH connections
 # See raspberry.exec.ssh_test()
 SSH_IDX = 12
+# The index of the 'env_copy' state in the 'deploy' process (see raspberry.exec.env_copy_exec())
+COPY_IDX = 4
 
 # Add the environment names to the 'environments' array to limit the process to specific environments
 PROCESS = {
@@ -61,20 +63,27 @@ PROCESS = {
 # State names must NOT include '_exec' or '_post'
 # 'lost' timeouts must be greater then 'before_reboot' timeouts
 # 0: infinite timeouts
+# Optional polling keys for the states that fail until a condition is met (default: every POLL_INTERVAL seconds):
+#   'poll': delay in seconds before the next execution of a failed state
+#   'backoff': the delay is multiplied by this factor after every failure
+#   'max_poll': the maximum delay in seconds between two executions
+# Optional 'lost_delay' key: the configuration key of a delay in seconds (default: 0) added to the 'lost' timeout
 # The states must be ordered according to the process values
 STATE_DESC = {
     'boot_conf': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 5 },
     'turn_off': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 5 },
-    'turn_on': { 'exec': True, 'post': True, 'before_reboot': 60, 'lost': 90 },
+    'turn_on': { 'exec': True, 'post': True, 'before_reboot': 60, 'lost': 90, 'poll': 2, 'backoff': 1.5, 'max_poll': 10 },
     # First boot of picore systems can be very long
-    'ssh_test': { 'exec': False, 'post': True, 'before_reboot': 300, 'lost': 330 },
-    'env_copy': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 30 },
-    'env_check': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 400 },
+    'ssh_test': { 'exec': False, 'post': True, 'before_reboot': 300, 'lost': 330, 'poll': 5, 'backoff': 1.5, 'max_poll': 30 },
+    # The copy can wait for the other nodes deploying the same environment (see 'env_relay')
+    'env_copy': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 30, 'lost_delay': 'env_relay_wait',
+        'poll': 5 },
+    'env_check': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 400, 'poll': 10 },
     'delete_partition': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 5 },
     'create_partition': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 5 },
     'mount_partition': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 5 },
     'resize_partition': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 5 },
-    'wait_resizing': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 90 },
+    'wait_resizing': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 90, 'poll': 5 },
     'system_conf': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 5 },
     'boot_files': { 'exec': True, 'post': False, 'before_reboot': 20, 'lost': 5 },
     'user_conf': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 1 },
@@ -91,9 +100,9 @@ STATE_DESC = {
     # Final state: exec is False, post is False and the 2 timeouts are infinite (0)
     'booted': { 'exec': False, 'post': False, 'before_reboot': 0, 'lost': 0 },
 
-    'uncompress': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 0 },
+    'uncompress': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 0, 'poll': 10, 'backoff': 1.5, 'max_poll': 60 },
     'read_info': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 0 },
-    'img_upload': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 0 },
+    'img_upload': { 'exec': True, 'post': True, 'before_reboot': 0, 'lost': 0, 'poll': 10, 'backoff': 1.5, 'max_poll': 60 },
 
     'update_boot_files': { 'exec': True, 'post': False, 'before_reboot': 0, 'lost': 30 }
 }
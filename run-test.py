@@ -10,6 +10,7 @@ load_config(sys.argv[1])
 
 from database.connector import open_session, close_session
 from database.tables import Schedule
+from sqlalchemy import text
 import json, requests, traceback
 
 # The API port (see files/config_agent.json)
@@ -20,6 +21,17 @@ api_token = "123456789"
 url = []
 error_url = []
 idx_list = []
+# The queries of the executor and the API that must use an index (SQLite databases)
+hot_queries = [
+    "SELECT * FROM schedule WHERE end_date < 1600000000",
+    "SELECT * FROM schedule WHERE state = 'ready' AND action_state = '' AND start_date < 1600000000",
+    "SELECT * FROM schedule WHERE state = 'in_progress' AND node_name IN ('imt-27', 'imt-20')",
+    "SELECT * FROM schedule WHERE owner = 'testing@piseduce'",
+    "SELECT * FROM action WHERE state IN ('deployed', 'destroyed', 'lost')",
+    "SELECT * FROM action_prop WHERE node_name = 'imt-27' AND prop_name = 'reboot_state'",
+    "SELECT * FROM action_prop WHERE node_name IN ('imt-27', 'imt-20')",
+    "SELECT * FROM node_conf WHERE node_name IN ('imt-27', 'imt-20')"
+]
 
 def test_last_url(post_args, expected_json):
     test_ok = False
@@ -386,6 +398,80 @@ except:
     print("Something bad happened again...")
     error_url.append("%d: %s" % (len(url) - 1, url[-1]))
 
+### Check the query plans (the hot queries must not scan the whole tables)
+if get_config()["db_url"].startswith("sqlite"):
+    db = open_session()
+    for query in hot_queries:
+        print("______________________________________________________")
+        print("Query plan of '%s'" % query)
+        for plan_row in db.execute(text("EXPLAIN QUERY PLAN %s" % query)).fetchall():
+            detail = plan_row[-1]
+            print("  %s" % detail)
+            if detail.startswith("SCAN") and "USING" not in detail:
+                error_url.append("full table scan: %s" % query)
+    close_session(db)
+
+### Check the new actions do not inherit the polling values of the previous action of the node
+print("______________________________________________________")
+print("New action replacing an action with a backoff")
+try:
+    from agent_exec import init_action_process, new_action
+    from database.tables import Action, RaspNode
+    db = open_session()
+    busy = [ a.node_name for a in db.query(Action.node_name).all() ]
+    free_node = db.query(RaspNode).filter(~RaspNode.name.in_(busy + [ "pimaster" ])).first()
+    if free_node is None:
+        error_url.append("new action: no free node")
+    else:
+        old_action = Action(node_name = free_node.name, node_ip = free_node.ip, process = "deploy",
+            state = "ssh_test", state_idx = 3, next_run = 9999999999, failures = 7)
+        db.add(old_action)
+        db.flush()
+        db_node = Schedule(node_name = free_node.name, state = "ready")
+        new_act = new_action(db_node, db)
+        init_action_process(new_act, "destroy")
+        db.add(new_act)
+        db.flush()
+        db.expire_all()
+        saved = db.query(Action).filter(Action.node_name == free_node.name).first()
+        if saved.next_run is not None or saved.failures != 0 or saved.process != "destroy":
+            error_url.append("new action: next_run=%s, failures=%s" % (saved.next_run, saved.failures))
+        db.delete(saved)
+    close_session(db)
+except:
+    traceback.print_exc()
+    error_url.append("new action")
+
+### Check the relay chains of the environment copies (at least 2 nodes in the chain)
+print("______________________________________________________")
+print("Relay chain of the nodes waiting in the 'env_copy' state")
+try:
+    from database.tables import Action, RaspNode
+    from raspberry.exec import relay_nodes
+    from raspberry.states import COPY_IDX
+    db = open_session()
+    busy = [ a.node_name for a in db.query(Action.node_name).all() ]
+    free_nodes = [ n for n in db.query(RaspNode).filter(~RaspNode.name.in_(busy)).all() if n.name != "pimaster" ][:3]
+    if len(free_nodes) < 2:
+        error_url.append("relay chain: %d free nodes" % len(free_nodes))
+    else:
+        relay_actions = []
+        for node in free_nodes:
+            relay_action = Action(node_name = node.name, node_ip = node.ip, environment = "relay_test",
+                process = "deploy", state = "env_copy", state_idx = COPY_IDX)
+            db.add(relay_action)
+            relay_actions.append(relay_action)
+        db.flush()
+        chain = relay_nodes(relay_actions[0], db, { "nodes": { n.name: n for n in free_nodes } })
+        if len(chain) != len(free_nodes) or chain[0][0] != free_nodes[0].name:
+            error_url.append("relay chain: %s" % [ n[0] for n in chain ])
+        for relay_action in relay_actions:
+            db.delete(relay_action)
+    close_session(db)
+except:
+    traceback.print_exc()
+    error_url.append("relay chain")
+
 # Clean the database
 db = open_session()
 for s in db.query(Schedule).filter(Schedule.owner == "testing@piseduce").all():